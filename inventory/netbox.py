@@ -6,9 +6,13 @@
 
 import os
 import sys
+import time
 import yaml
+import hashlib
 import argparse
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 logging.basicConfig(stream=sys.stderr, level=logging.INFO)
 
 try:
@@ -24,6 +28,9 @@ try:
 except ImportError:
     import simplejson as json
 
+# Seconds of overlap between incremental syncs, covers the clock skew with netbox
+SYNC_OVERLAP = 300
+
 
 # Script.
 def cli_arguments():
@@ -78,18 +85,35 @@ class NetboxAsInventory(object):
 
         self.inventory_dict = dict()
 
-        self.req = requests.session()
         self.verify_certs = False
 
         # Script configuration.
         self.script_config = script_config_data
         self.api_url = self._config(["main", "api_url"])
+
+        # Paging and concurrency of the queries to netbox
+        self.page_size = int(self._config(["main", "page_size"], default=1000))
+        self.max_workers = int(self._config(["main", "max_workers"], default=4))
+        self.retries = int(self._config(["main", "retries"], default=3))
+        self.timeout = float(self._config(["main", "timeout"], default=10.0))
+
+        # One pooled session shared by all threads, the number of requests in flight is bounded
+        self.req = requests.session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.max_workers)
+        self.req.mount('http://', adapter)
+        self.req.mount('https://', adapter)
+        self._requests_slots = threading.BoundedSemaphore(self.max_workers)
         self.tags = self._config(["tags"], default={})
         self.filters = self._config(["filters"], default={})
         self.context = self._config(["context"], default={})
 
         self.device_type = self._config(["device_type"], default='device_type/manufacturer/slug')
 
+        # Incremental sync, enabled when a snapshot file is configured
+        main_config = self.script_config["netbox"].get("main") or {}
+        self.cache_file = main_config.get("cache_file")
+        self.full_sync_interval = int(main_config.get("full_sync_interval", 86400))
+
         # Get value based on key.
         self.key_map = {
             "default": "name",
@@ -172,10 +196,36 @@ class NetboxAsInventory(object):
             sys.exit("Please check API URL in script configuration file.")
 
         logging.info('Getting hosts list from netbox')
-        api_url_params = ""
 
-        # Add filters provided into the URL
-        # Filter can be a list or a dict, if it's a dict we need to query Net box multiple times
+        groups_params = self.get_filter_groups_params(filters)
+        if groups_params == ['']:
+            return self.netbox_get_devices_list()
+
+        global_hosts_list_json = {
+            'results': [],
+            'count': 0
+        }
+
+        # Query all filter groups at the same time
+        with ThreadPoolExecutor(max_workers=len(groups_params)) as executor:
+            groups_hosts_list_json = list(executor.map(self.netbox_get_devices_list, groups_params))
+
+        for grp_hosts_list_json in groups_hosts_list_json:
+            global_hosts_list_json['results'] += grp_hosts_list_json['results']
+            global_hosts_list_json['count'] += grp_hosts_list_json['count']
+
+        logging.info('Got {} global hosts from netbox'.format(global_hosts_list_json['count']))
+        return global_hosts_list_json
+
+    def get_filter_groups_params(self, filters=None):
+        """Build the URL params of each filter group.
+
+        Filter can be a list or a dict, if it's a dict we need to query Net box multiple times
+
+        Returns:
+            A list of URL params, [''] if no filter is defined.
+        """
+
         filter_groups = None
         if filters:
             if isinstance(filters, list):
@@ -184,37 +234,27 @@ class NetboxAsInventory(object):
                 filter_groups = filters 
 
         if not filter_groups:
-            return self.netbox_get_devices_list()
-
-        else:
-            global_hosts_list_json = {
-                'results': [],
-                'count': 0
-            }
-            
-            for grp_name, grp_filters in filter_groups.items():
-                grp_api_url_params = ""
+            return ['']
 
-                for grp_filter in grp_filters:
-                    for key,value in grp_filter.items():
+        groups_params = []
+        for grp_name, grp_filters in filter_groups.items():
+            grp_api_url_params = ""
 
-                        if key == "limit" or key == "offset":
-                            continue
+            for grp_filter in grp_filters:
+                for key,value in grp_filter.items():
 
-                        if isinstance(value, list):
-                            for v in value:
-                                grp_api_url_params += "%s=%s&" % (key, v)
-                        else:
-                            grp_api_url_params += "%s=%s&" % (key, value)
+                    if key == "limit" or key == "offset":
+                        continue
 
-                grp_hosts_list_json = self.netbox_get_devices_list(grp_api_url_params)
+                    if isinstance(value, list):
+                        for v in value:
+                            grp_api_url_params += "%s=%s&" % (key, v)
+                    else:
+                        grp_api_url_params += "%s=%s&" % (key, value)
 
-                global_hosts_list_json['results'] += grp_hosts_list_json['results']
-                global_hosts_list_json['count'] += grp_hosts_list_json['count']
-
-            logging.info('Got {} global hosts from netbox'.format(global_hosts_list_json['count']))
-            return global_hosts_list_json
+            groups_params.append(grp_api_url_params)
 
+        return groups_params
 
     def add_host_to_inventory(self, host_data):
         """Add a host to the inventory.
@@ -330,6 +370,12 @@ class NetboxAsInventory(object):
             A dict has inventory with hosts and their tags and context
         """
 
+        if self.cache_file:
+            return self.generate_inventory_incremental()
+
+        # The instance is reused between refreshes when running in-process
+        self.inventory_dict = dict()
+
         netbox_hosts_list = self.get_hosts_list(self.filters)
 
         if isinstance(netbox_hosts_list, dict) and "results" in netbox_hosts_list:
@@ -350,6 +396,145 @@ class NetboxAsInventory(object):
 
         return self.inventory_dict
 
+    def build_host_entry(self, host_data):
+        """Build the inventory entry of a host.
+
+        Returns:
+            The entry (tags, address, context, device_type) or None if the host is skipped.
+        """
+
+        device_name = host_data.get("name")
+        if not device_name or not self.add_host_to_inventory(host_data):
+            return None
+
+        entry = self.inventory_dict.pop(device_name)
+        entry['context'] = self.get_context(host_data)
+        return entry
+
+    def generate_inventory_incremental(self):
+        """Generate the inventory from the local snapshot and the changes since the last sync
+
+        Only the devices updated since the last sync (last_updated__gte) are
+        downloaded and processed. Deleted devices, or devices that don't match
+        the filters anymore, are found by comparing the snapshot with an id only
+        listing (brief=1) of each filter group. A full sync is done when there is
+        no snapshot, the configuration changed or every full_sync_interval, as
+        changes of related objects (site, platform...) don't update the devices.
+
+        Returns:
+            A dict has inventory with hosts and their tags and context
+        """
+
+        sync_time = time.time()
+        groups_params = self.get_filter_groups_params(self.filters)
+        snapshot = self.load_snapshot()
+
+        if snapshot is None or sync_time - snapshot['last_full_sync'] > self.full_sync_interval:
+            logging.info('Full sync of the inventory from netbox')
+            snapshot = {
+                'config': self.get_config_hash(),
+                'last_full_sync': sync_time,
+                'groups': {},
+            }
+            since = None
+        else:
+            # Overlap with the previous sync to not miss changes because of clock skew
+            since = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(snapshot['last_sync'] - SYNC_OVERLAP))
+            logging.info('Getting devices updated in netbox since {}'.format(since))
+
+        with ThreadPoolExecutor(max_workers=len(groups_params)) as executor:
+            groups_changes = list(executor.map(
+                lambda params: self.netbox_get_group_changes(params, snapshot['groups'].get(params), since),
+                groups_params
+            ))
+
+        groups = {}
+        nbr_changes = 0
+        for params, (changed_hosts, current_ids) in zip(groups_params, groups_changes):
+            devices = snapshot['groups'].get(params, {})
+            if current_ids is not None:
+                devices = { dev_id: dev for dev_id, dev in devices.items() if dev_id in current_ids }
+            for host_data in changed_hosts:
+                devices[str(host_data['id'])] = [host_data.get("name"), self.build_host_entry(host_data)]
+            nbr_changes += len(changed_hosts)
+            groups[params] = devices
+
+        snapshot['groups'] = groups
+        snapshot['last_sync'] = sync_time
+        self.save_snapshot(snapshot)
+
+        inventory = {}
+        for params in groups_params:
+            for device_name, entry in groups[params].values():
+                if entry:
+                    inventory[device_name] = entry
+
+        logging.info('Processed {} changed devices, {} hosts in the inventory'.format(nbr_changes, len(inventory)))
+        return inventory
+
+    def netbox_get_group_changes(self, params, devices, since):
+        """Get the changes of a filter group since the last sync.
+
+        Args:
+            params: Filters of the group.
+            devices: Devices of the group in the snapshot, [name, entry] by id.
+            since: Date of the last sync, None for a full sync.
+
+        Returns:
+            (devices to process, ids of all devices of the group or None for a full sync)
+        """
+
+        if since is None or devices is None:
+            return self.netbox_get_devices_list(params)['results'], None
+
+        current_ids = set(str(host['id']) for host in self.netbox_get_devices_list(params + 'brief=1&')['results'])
+        changed_hosts = self.netbox_get_devices_list(params + 'last_updated__gte=%s&' % since, allow_empty=True)['results']
+
+        # Devices that entered the group without being updated (deleted filter, snapshot lost...)
+        missing_ids = sorted(current_ids - set(devices) - set(str(host['id']) for host in changed_hosts))
+        for i in range(0, len(missing_ids), self.page_size):
+            ids_params = ''.join('id=%s&' % dev_id for dev_id in missing_ids[i:i + self.page_size])
+            changed_hosts += self.netbox_get_devices_list(params + ids_params, allow_empty=True)['results']
+
+        return changed_hosts, current_ids
+
+    def get_config_hash(self):
+        """Hash of the configuration used to build the entries, the snapshot is discarded if it changes"""
+
+        config = [self.api_url, self.filters, self.tags, self.context, self.device_type]
+        return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+    def load_snapshot(self):
+        """Load the snapshot of the last sync.
+
+        Returns:
+            The snapshot or None if it doesn't exist, can't be read or was built with another configuration.
+        """
+
+        try:
+            with open(self.cache_file, 'r') as f:
+                snapshot = json.load(f)
+        except (IOError, ValueError) as error:
+            logging.info('Unable to load netbox snapshot {}: {}'.format(self.cache_file, error))
+            return None
+
+        if not isinstance(snapshot, dict) or snapshot.get('config') != self.get_config_hash():
+            logging.info('Netbox snapshot {} was built with another configuration'.format(self.cache_file))
+            return None
+
+        return snapshot
+
+    def save_snapshot(self, snapshot):
+        """Write the snapshot atomically, so that a crash never leaves a partial file."""
+
+        tmp_file = self.cache_file + '.tmp'
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump(snapshot, f, separators=(',', ':'))
+            os.replace(tmp_file, self.cache_file)
+        except (IOError, OSError) as error:
+            logging.error('Unable to save netbox snapshot {}: {}'.format(self.cache_file, error))
+
     def print_inventory_json(self, inventory_dict):
         """Print inventory.
 
@@ -362,7 +547,47 @@ class NetboxAsInventory(object):
 
         print(json.dumps(inventory_dict, sort_keys=True,indent=4,))
 
-    def netbox_get_devices_list(self, params=''):
+    def netbox_get_page(self, params, offset):
+        """Get one page of the devices list, retried on failure.
+
+        Args:
+            params: Filters of the query.
+            offset: Offset of the page.
+
+        Returns:
+            The response of netbox as a dict (count, results).
+        """
+
+        paging_params = "offset=%s&limit=%s" % (offset, self.page_size)
+
+        if params == "":
+            api_url_params = paging_params
+        else:
+            api_url_params = params + "&" + paging_params
+
+        for attempt in range(1, self.retries + 1):
+            try:
+                with self._requests_slots:
+                    hosts_list = self.req.get(self.api_url,
+                                            params=api_url_params,
+                                            verify=self.verify_certs,
+                                            timeout=self.timeout)
+                hosts_list.raise_for_status()
+                return hosts_list.json()
+
+            except (requests.exceptions.RequestException, ValueError) as error:
+                if attempt == self.retries:
+                    raise
+                logging.warning('Error getting page {} from netbox ({}), retrying [{}/{}]'.format(
+                    api_url_params, error, attempt, self.retries))
+                time.sleep(0.5 * attempt)
+
+    def netbox_get_devices_list(self, params='', allow_empty=False):
+        """Get all devices matching params.
+
+        The first page gives the number of devices, the other pages are then
+        fetched concurrently.
+        """
        
         logging.info('Quering netbox for devices list with params: {}'.format(params))
         results = {
@@ -370,39 +595,30 @@ class NetboxAsInventory(object):
             'results': []
         }
 
-        offset = 0
-        netbox_batch_size = 1000
-        keep_querying = True
-
-        while keep_querying:
-    
-            paging_params = "offset=%s&limit=%s" % (offset, netbox_batch_size)
+        first_page = self.netbox_get_page(params, 0)
+        results['count'] = first_page['count']
+        results['results'].extend(first_page['results'])
 
-            if params == "":
-                api_url_params = paging_params
-            else:
-                api_url_params = params + "&" + paging_params
-              
-            hosts_list = self.req.get(self.api_url, 
-                                    params=api_url_params, 
-                                    verify=self.verify_certs,
-                                    timeout=10.0)
+        offsets = range(self.page_size, int(first_page['count']), self.page_size)
+        if offsets:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                for page in executor.map(lambda offset: self.netbox_get_page(params, offset), offsets):
+                    results['results'].extend(page['results'])
 
-            hosts_list.raise_for_status()
+        if not allow_empty and (results['count'] == 0 or len(results['results']) == 0):
+            logging.error("Got 0 results from netbox !")
+            sys.exit("No results returned from netbox")
+        return results
 
-            hosts_list_dict = hosts_list.json()
 
-            results['count'] = hosts_list_dict['count']
-            results['results'].extend(hosts_list_dict['results'])
+def inventory_plugin():
+    """Create the inventory when running in-process as a py-metric-collector inventory plugin.
 
-            offset += netbox_batch_size
-            if int(hosts_list_dict['count']) < offset:
-                keep_querying = False
+    The configuration file is taken from NETBOX_CONFIG_FILE or netbox.yml, the
+    same instance (and HTTP session) is used for every refresh of the inventory.
+    """
 
-        if results['count'] == 0 or len(results['results']) == 0:
-            logging.error("Got 0 results from netbox !")
-            sys.exit("No results returned from netbox")
-        return results
+    return NetboxAsInventory(open_yaml_file(os.getenv("NETBOX_CONFIG_FILE", "netbox.yml")))
 
 
 # Main.
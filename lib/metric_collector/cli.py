@@ -23,7 +23,7 @@ import yaml
 import copy
 
 from metric_collector import (
-    parser_manager, host_manager, collector, scheduler, utils
+    parser_manager, host_manager, collector, scheduler, spool, output, inventory, shards
 )
 
 logging.getLogger("paramiko").setLevel(logging.INFO)
@@ -36,11 +36,15 @@ logger = logging.getLogger('main')
 global_measurement_prefix = 'metric_collector'
 
 
-def shard_host_list(shard_id, shard_size, hosts): 
+def shard_host_list(shard_id, shard_size, hosts, mode='modulo', weights=None): 
     """
     Take a dict of hosts as input and return a subset of this dict based on the size of the shard
 
     shard_id starts at 1
+    mode is either modulo (index in the sorted list of hosts), rendezvous
+    (consistent hashing, optionally balanced with the weights of the hosts,
+    see shards.assign_shards) or cost (bin-packing on the weights of the
+    hosts, see shards.pack_shards)
     """
     logger.info('Using shard_id: {} , shard_size: {} on {} hosts'.format(shard_id, shard_size, len(hosts)))
     if shard_id == 0:
@@ -50,21 +54,55 @@ def shard_host_list(shard_id, shard_size, hosts):
 
     shard_id -= 1
 
-    hosts_list = sorted(hosts.keys())
+    if mode in ('rendezvous', 'cost'):
+        if mode == 'rendezvous':
+            assignment = shards.assign_shards(list(hosts), shard_size, weights=weights)
+        else:
+            assignment = shards.pack_shards(list(hosts), shard_size, weights=weights)
+        for host, shard in assignment.items():
+            if shard != shard_id:
+                del hosts[host]
+
+    else:
+        hosts_list = sorted(hosts.keys())
 
-    for i in range(0, len(hosts_list)):
-        if i % shard_size != shard_id:
-            del hosts[hosts_list[i]]
+        for i in range(0, len(hosts_list)):
+            if i % shard_size != shard_id:
+                del hosts[hosts_list[i]]
 
     logger.info('Got {} hosts in this shard'.format(len(hosts)))
     return hosts
 
 
-def select_hosts(hosts_file, tag_list, sharding, sharding_offset, scheduler=None, refresh_interval=None, refresh=False, allow_zero_hosts=False):
+def select_hosts(hosts_file, tag_list, sharding, sharding_offset, scheduler=None, refresh_interval=None, refresh=False,
+                 allow_zero_hosts=False, hosts_cache=None, sharding_mode='modulo', sharding_weights=None,
+                 sharding_weights_epoch=shards.DEFAULT_WEIGHTS_EPOCH):
     """
     Parse a host file or pull hosts from dynamic inventory , and add it to the scheduler periodically
+
+    With hosts_cache (inventory.InventoryCache), the last known good inventory is
+    used when the inventory can't be imported, and the scheduler starts with the
+    cached inventory while the inventory is imported in the background
+
+    sharding_weights is a static file of host: weight or a cost store whose
+    snapshot of the current epoch (of sharding_weights_epoch secs) is used,
+    reloaded at each refresh
     """
-    hosts = import_inventory(hosts_file = hosts_file)
+    next_refresh = refresh_interval
+    if scheduler and hosts_cache and not refresh and hosts_cache.load():
+        hosts = dict(hosts_cache.hosts)
+        logger.info('Starting with %s hosts from the inventory cache (%d sec old), refreshing it in the background',
+                    len(hosts), hosts_cache.get_age())
+        next_refresh = 0
+    else:
+        hosts = import_inventory(hosts_file = hosts_file)
+        if hosts_cache and len(hosts) > 0:
+            hosts_cache.update(hosts)
+        elif hosts_cache and hosts_cache.failed():
+            hosts = dict(hosts_cache.hosts)
+            logger.warning('Unable to import the inventory, using %s hosts from the inventory cache (%d sec old)',
+                           len(hosts), hosts_cache.get_age())
+
     if len(hosts) == 0 and not allow_zero_hosts:
         sys.exit("Failed to get any hosts !")
 
@@ -81,24 +119,63 @@ def select_hosts(hosts_file, tag_list, sharding, sharding_offset, scheduler=None
         if sharding_offset:
             shard_id += 1
 
-        hosts = shard_host_list(shard_id, shard_size, hosts)
+        weights = None
+        if sharding_mode != 'modulo' and sharding_weights:
+            weights = shards.load_weights(sharding_weights, epoch=sharding_weights_epoch)
+
+        hosts = shard_host_list(shard_id, shard_size, hosts, mode=sharding_mode, weights=weights)
 
     if scheduler:
         scheduler.add_hosts(hosts, host_tags=tag_list, refresh=refresh)
         t = threading.Timer(
-            refresh_interval, select_hosts,
+            next_refresh, select_hosts,
             args=(hosts_file, tag_list, sharding, sharding_offset),
             kwargs={'scheduler': scheduler, 'refresh_interval': refresh_interval, 'refresh': True,
-                    'allow_zero_hosts': allow_zero_hosts},
+                    'allow_zero_hosts': allow_zero_hosts, 'hosts_cache': hosts_cache,
+                    'sharding_mode': sharding_mode, 'sharding_weights': sharding_weights,
+                    'sharding_weights_epoch': sharding_weights_epoch},
         )
         t.setDaemon(True)
         t.start()
     else:
         return hosts
 
+def build_outputs(output_specs, output_addr=None, spool_dir=None, spool_max_size=512, queue_size=1000):
+    """
+    Create all outputs from a list of <type> or <type>=<addr>
+
+    Return an OutputManager that fans out datapoints to all outputs
+    """
+    outputs = []
+    nbr_http = len([o for o in output_specs if o.partition('=')[0] == 'http'])
+
+    for i, output_spec in enumerate(output_specs):
+        output_type, _, addr = output_spec.partition('=')
+        if not addr and len(output_specs) == 1:
+            addr = output_addr
+
+        kwargs = {}
+        if output_type == 'http' and spool_dir:
+            ## Each http output needs its own spool to replay data to the right place
+            kwargs['spool'] = spool.Spool(
+                spool_dir if nbr_http == 1 else os.path.join(spool_dir, 'http-{}'.format(i)),
+                max_size=spool_max_size * 1024 * 1024
+            )
+
+        try:
+            outputs.append(output.create_output(output_type, addr, **kwargs))
+        except (ValueError, OSError) as ex:
+            logger.error('Unable to create %s output: %s', output_type, str(ex))
+            sys.exit(1)
+        logger.info('Sending datapoints to %s output (%s)', output_type, outputs[-1].addr)
+
+    return output.OutputManager(outputs, queue_size=queue_size)
+
+
 def import_inventory(hosts_file, retry=3, retry_internal=5): 
     """
-    Import the inventory either from a yaml file or from a dynamic inventory script
+    Import the inventory either from a yaml file, an inventory plugin running
+    in-process (see inventory.get_plugin) or from a dynamic inventory script
 
     Return a dict of hosts
     """
@@ -107,7 +184,7 @@ def import_inventory(hosts_file, retry=3, retry_internal=5):
     BASE_DIR = os.getcwd()
 
     ### check if the file is present
-    if not os.path.isfile(hosts_file):
+    if not hosts_file.startswith(inventory.ENTRY_POINT_PREFIX) and not os.path.isfile(hosts_file):
         hosts_file_full = BASE_DIR + "/"+ hosts_file
 
         if not os.path.isfile(hosts_file_full):
@@ -128,14 +205,29 @@ def import_inventory(hosts_file, retry=3, retry_internal=5):
         is_yaml = False
         is_exec = False
 
+        plugin = None
         try:
-            with open(hosts_file) as f:
-                hosts = yaml.full_load(f)
-            is_yaml = True
-        except Exception as e:
-            logger.debug('Error importing host file in yaml: %s > %s [%s/%s]' % (hosts_file, e, i, retry ))
+            plugin = inventory.get_plugin(hosts_file)
+        except (Exception, SystemExit) as e:
+            logger.error('Error loading inventory plugin: %s > %s [%s/%s]' % (hosts_file, e, i, retry))
 
-        if not is_yaml:
+        if plugin:
+            try:
+                hosts = plugin.generate_inventory()
+                is_exec = True
+            except (Exception, SystemExit) as e:
+                ## Plugins written as scripts may still call sys.exit on errors
+                logger.error('Error importing hosts from inventory plugin: %s > %s [%s/%s]' % (hosts_file, e, i, retry))
+                hosts = {}
+        else:
+            try:
+                with open(hosts_file) as f:
+                    hosts = yaml.full_load(f)
+                is_yaml = True
+            except Exception as e:
+                logger.debug('Error importing host file in yaml: %s > %s [%s/%s]' % (hosts_file, e, i, retry ))
+
+        if not plugin and not is_yaml:
             try:
                 output_str = run(["python", hosts_file], capture_output=True, check=True)
                 hosts = json.loads(output_str.stdout)
@@ -197,28 +289,37 @@ def main():
     
     full_parser.add_argument("--sharding",  help="Define if the script is part of a shard need to include the place in the shard and the size of the shard [0/3]")
     full_parser.add_argument("--sharding-offset", default=True, help="Define an offset needs to be applied to the shard_id")
+    full_parser.add_argument("--sharding-mode", default="modulo", choices=shards.SHARDING_MODES, help="modulo on the sorted list of hosts, rendezvous (consistent) hashing that moves only ~1/N of the hosts when hosts or shards change, or cost to balance the shards on the cost of the hosts")
+    full_parser.add_argument("--sharding-weights", default=None, help="Rendezvous/cost sharding: static file of host: weight (cost of the host), identical on all collectors, to balance the load of the shards. Cost sharding defaults to --cost-store")
+    full_parser.add_argument("--cost-store", default=None, help="File where to record the execution time of each command of each host, can be shared by all collectors")
+    full_parser.add_argument("--cost-store-epoch", type=int, default=shards.DEFAULT_WEIGHTS_EPOCH, help="Cost sharding: secs during which the weights frozen from the cost store don't change, the same on all collectors")
 
     full_parser.add_argument("--parserdir", default="parsers", help="Directory where to find parsers")
     full_parser.add_argument("--collector-timeout", default=15, help="Timeout for collector device rpc/rest calls")
     full_parser.add_argument("--retry", default=5, help="Max retry")
 
     full_parser.add_argument("--host", default=None, help="Host DNS or IP")
-    full_parser.add_argument("--hosts", default="hosts.yaml", help="Hosts file in yaml")
+    full_parser.add_argument("--hosts", default="hosts.yaml", help="Hosts file in yaml, dynamic inventory script or plugin:<name>")
     full_parser.add_argument("--commands", default="commands.yaml", help="Commands file in Yaml")
     full_parser.add_argument("--credentials", default="credentials.yaml", help="Credentials file in Yaml")
 
     full_parser.add_argument("--no-facts", action='store_false', help="Disable facts collection on device (remove version and product name in results)")
     
     full_parser.add_argument("--output-format", default="influxdb", help="Format of the output")
-    full_parser.add_argument("--output-type", default="stdout", choices=['stdout', 'http'], help="Type of output")
-    full_parser.add_argument("--output-addr", default="http://localhost:8186/write", help="Addr information for output action")
+    full_parser.add_argument("--output-type", default=["stdout"], nargs='+',
+                             help="Type of output, multiple outputs can be defined as <type>=<addr> ({})".format(', '.join(output.get_output_types())))
+    full_parser.add_argument("--output-addr", default=None, help="Addr information for output action when a single output is defined")
+    full_parser.add_argument("--output-queue-size", type=int, default=1000, help="Maximum number of batches waiting to be sent per output (default 1000)")
+    full_parser.add_argument("--spool-dir", default=None, help="Directory where to spool datapoints that failed to be sent to the http output")
+    full_parser.add_argument("--spool-max-size", type=int, default=512, help="Maximum size of the spool in MB, oldest data is evicted first (default 512)")
 
     full_parser.add_argument("--no-collector-threads", action='store_true', help="Dont Spawn multiple threads to collect the information on the devices")
     full_parser.add_argument("--nbr-collector-threads", type=int, default=10, help="Maximum number of collector thread to spawn (default 10)")
-    full_parser.add_argument("--max-worker-threads", type=int, default=1, help="Maximum number of worker threads per interval for scheduler")
+    full_parser.add_argument("--max-worker-threads", type=int, default=1, help="Scheduler: size of the shared pool of collector threads, in multiple of --nbr-collector-threads")
     full_parser.add_argument("--use-scheduler", action='store_true', help="Use scheduler")
     full_parser.add_argument("--hosts-refresh-interval", type=int, default=3*60*60, help="Interval to periodically refresh dynamic host inventory")
     full_parser.add_argument("--allow-zero-hosts", action='store_true', help="Allow scheduler to run even with 0 hosts")
+    full_parser.add_argument("--hosts-cache", default=None, help="File where to keep the last known good inventory, used at startup and when the inventory can't be imported")
 
     dynamic_args = vars(full_parser.parse_args())
 
@@ -318,23 +419,50 @@ def main():
 
     sharding = dynamic_args.get('sharding')
     sharding_offset = dynamic_args.get('sharding_offset')
+    cost_store = None
+    if dynamic_args.get('cost_store'):
+        cost_store = shards.CostStore(dynamic_args['cost_store'], epoch=dynamic_args['cost_store_epoch'])
+
+    sharding_kwargs = {
+        'sharding_mode': dynamic_args.get('sharding_mode', 'modulo'),
+        ## Weights must be the same on all collectors: rendezvous is only weighted by a static
+        ## file given explicitly, never by the costs measured continuously
+        'sharding_weights': dynamic_args.get('sharding_weights') or (
+            dynamic_args.get('cost_store') if dynamic_args.get('sharding_mode') == 'cost' else None),
+        'sharding_weights_epoch': dynamic_args.get('cost_store_epoch', shards.DEFAULT_WEIGHTS_EPOCH),
+    }
     max_worker_threads = dynamic_args.get('max_worker_threads', 1)
     max_collector_threads = dynamic_args.get('nbr_collector_threads')
 
+    outputs = build_outputs(
+        dynamic_args['output_type'], output_addr=dynamic_args['output_addr'],
+        spool_dir=dynamic_args['spool_dir'], spool_max_size=dynamic_args['spool_max_size'],
+        queue_size=dynamic_args['output_queue_size']
+    )
+
+    hosts_cache = None
+    if dynamic_args.get('hosts_cache'):
+        hosts_cache = inventory.InventoryCache(dynamic_args['hosts_cache'])
+
     if dynamic_args.get('use_scheduler', False):
         device_scheduler = scheduler.Scheduler(
             credentials, general_commands,  dynamic_args['parserdir'],
-            dynamic_args['output_type'], dynamic_args['output_addr'],
+            outputs,
             max_worker_threads=max_worker_threads,
             use_threads=use_threads, num_threads_per_worker=max_collector_threads,
-            collector_timeout=dynamic_args['collector_timeout']
+            collector_timeout=dynamic_args['collector_timeout'],
+            cost_store=cost_store
         )
+        if hosts_cache:
+            device_scheduler.stats_sources.append(hosts_cache)
         hri = dynamic_args.get('hosts_refresh_interval', 6 * 60 * 60)
         select_hosts(
             dynamic_args['hosts'], tag_list, sharding, sharding_offset,
             scheduler=device_scheduler,
             refresh_interval=float(hri),
             allow_zero_hosts=dynamic_args.get('allow_zero_hosts', False),
+            hosts_cache=hosts_cache,
+            **sharding_kwargs
         )
         device_scheduler.start()  # blocking call
         return
@@ -343,24 +471,34 @@ def main():
     ### LOAD all parsers
     ### ------------------------------------------------------------------------------
     parsers_manager = parser_manager.ParserManager( parser_dirs = dynamic_args['parserdir'] )
-    hosts_conf = select_hosts(dynamic_args['hosts'], tag_list, sharding, sharding_offset)
+    hosts_conf = select_hosts(dynamic_args['hosts'], tag_list, sharding, sharding_offset, hosts_cache=hosts_cache,
+                              **sharding_kwargs)
     hosts_manager = host_manager.HostManager(
         credentials=credentials,
-        commands=general_commands
+        commands=general_commands,
+        parser_manager=parsers_manager
     )
     hosts_manager.update_hosts(hosts_conf)
     coll = collector.Collector(
             hosts_manager=hosts_manager, 
             parser_manager=parsers_manager, 
-            output_type=dynamic_args['output_type'], 
-            output_addr=dynamic_args['output_addr'],
+            output=outputs,
             collect_facts=dynamic_args.get('no_facts', True),
-            timeout=dynamic_args['collector_timeout']
+            timeout=dynamic_args['collector_timeout'],
+            cost_store=cost_store
     )
     target_hosts = hosts_manager.get_target_hosts(tags=tag_list)
 
     if use_threads:
-        target_hosts_lists = [target_hosts[x:x+int(len(target_hosts)/max_collector_threads+1)] for x in range(0, len(target_hosts), int(len(target_hosts)/max_collector_threads+1))]
+        if cost_store and target_hosts:
+            ## Balance the threads on the measured cost of the hosts
+            nbr_threads = min(max_collector_threads, len(target_hosts))
+            assignment = shards.pack_shards(target_hosts, nbr_threads, weights=cost_store.get_host_costs())
+            target_hosts_lists = [[] for _ in range(nbr_threads)]
+            for host in target_hosts:
+                target_hosts_lists[assignment[host]].append(host)
+        else:
+            target_hosts_lists = [target_hosts[x:x+int(len(target_hosts)/max_collector_threads+1)] for x in range(0, len(target_hosts), int(len(target_hosts)/max_collector_threads+1))]
 
         jobs = []
 
@@ -385,6 +523,9 @@ def main():
     else:
         # Execute everythings in the main thread
         coll.collect('global', hosts=target_hosts, cmd_tags=command_tags)
+
+    if cost_store:
+        cost_store.save()
     
     ### -----------------------------------------------------
     ### Collect Global Statistics 
@@ -408,17 +549,24 @@ def main():
     if use_threads:
         global_datapoint[0]['fields']['nbr_threads'] = dynamic_args['nbr_collector_threads']
 
-    ### Send results to the right output
+    ### Send results to all outputs and wait for them to be sent
     try:
-        if dynamic_args['output_type'] == 'stdout':
-            utils.print_format_influxdb(global_datapoint)
-        elif dynamic_args['output_type'] == 'http':
-            utils.post_format_influxdb(global_datapoint, dynamic_args['output_addr'],)
-        else:
-            logger.warn('Output format unknown: %s', dynamic_args['output_type'])
+        outputs.write(global_datapoint)
     except Exception as ex:
-        logger.warn("Hit error trying to post to influx: ", str(ex))
-    
+        logger.warn("Hit error trying to send datapoints to the outputs: %s", str(ex))
+
+    ### Output counters are only final once all queues are drained
+    outputs.flush()
+    try:
+        outputs.write(outputs.get_stats_datapoints())
+    except Exception as ex:
+        logger.warn("Hit error trying to send the output stats to the outputs: %s", str(ex))
+    outputs.close()
+
+    logger.info('Output stats: %s', [
+        dict(dp['tags'], **dp['fields']) for dp in outputs.get_stats_datapoints()
+    ])
+
 
 if __name__ == "__main__":
     main()
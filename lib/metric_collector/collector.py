@@ -1,25 +1,26 @@
 import logging
-import itertools
 import requests
 import time
 import os
 from metric_collector import netconf_collector
 from metric_collector import f5_rest_collector
-from metric_collector import utils
+from metric_collector import pipeline
 
 logger = logging.getLogger('collector')
 global_measurement_prefix = 'metric_collector'
 
 class Collector:
 
-    def __init__(self, hosts_manager, parser_manager, output_type, output_addr,
-            collect_facts=True, timeout=30):
+    def __init__(self, hosts_manager, parser_manager, output,
+            collect_facts=True, timeout=30, cost_store=None):
         self.hosts_manager = hosts_manager
         self.parser_manager = parser_manager
-        self.output_type = output_type
-        self.output_addr = output_addr
+        self.output = output
         self.collect_facts = collect_facts
         self.timeout = timeout
+        self.pipeline = pipeline.Pipeline(parser_manager)
+        ## Optional shards.CostStore recording the execution time of each command
+        self.cost_store = cost_store
 
     def collect(self, worker_name, hosts=None, host_cmds=None, cmd_tags=None):
         if not hosts and not host_cmds:
@@ -29,31 +30,30 @@ class Collector:
             host_cmds = {}
             tags = cmd_tags or ['.*']
             for host in hosts:
-                cmds = self.hosts_manager.get_target_commands(host, tags=tags) 
                 target_cmds = []
-                for c in cmds:
-                    target_cmds += c['commands']
+                for interval, cmds in sorted(self.hosts_manager.get_host_commands(host, tags=tags).items()):
+                    target_cmds += cmds
                 host_cmds[host] = target_cmds
                
         for host, target_commands in host_cmds.items():
             values = []
-            credential = self.hosts_manager.get_credentials(host)
+            plan = self.hosts_manager.get_host_plan(host)
+            if plan is None:
+                logger.warning('Collector: %s is not in the inventory anymore, skipping', host)
+                continue
 
             host_reachable = False
 
             logger.info('Collector starting for: %s', host)
-            host_address = self.hosts_manager.get_address(host)
-            host_context = self.hosts_manager.get_context(host)
-            device_type = self.hosts_manager.get_device_type(host)
 
-            if device_type == 'juniper':
+            if plan.device_type == 'juniper':
                 dev = netconf_collector.NetconfCollector(
-                        host=host, address=host_address, credential=credential,
-                        parsers=self.parser_manager, context=host_context, collect_facts=self.collect_facts, timeout=self.timeout)
-            elif device_type == 'f5':
+                        host=host, address=plan.address, credential=plan.credential,
+                        parsers=self.parser_manager, context=plan.context, collect_facts=self.collect_facts, timeout=self.timeout)
+            elif plan.device_type == 'f5':
                 dev = f5_rest_collector.F5Collector(
-                    host=host, address=host_address, credential=credential,
-                    parsers=self.parser_manager, context=host_context, timeout=self.timeout)
+                    host=host, address=plan.address, credential=plan.credential,
+                    parsers=self.parser_manager, context=plan.context, timeout=self.timeout)
             dev.connect()
 
             if dev.is_connected():
@@ -75,9 +75,12 @@ class Collector:
                 for command in target_commands:
                     try:
                         logger.info('[%s] Collecting > %s' % (host,command))
-                        data = dev.collect(command)  # returns a generator
-                        if data:
-                            values.append(data)
+                        cmd_start = time.time()
+                        data = dev.collect(command)  # returns a DatapointBatch
+                        if self.cost_store is not None:
+                            self.cost_store.record(host, command, time.time() - cmd_start)
+                        if data is not None:
+                            values.append(self.pipeline.process(host, command, data))
                             cmd_successful += 1
 
                     except Exception as err:
@@ -106,7 +109,7 @@ class Collector:
                 'timestamp': time.time_ns(),
             }]
 
-            host_time_datapoint[0]['tags'].update(dev.context)
+            host_time_datapoint[0]['tags'].update(plan.context)
             
             if os.environ.get('NOMAD_JOB_NAME'):
                 host_time_datapoint[0]['tags']['nomad_job_name'] = os.environ['NOMAD_JOB_NAME']
@@ -115,19 +118,13 @@ class Collector:
             if os.environ.get('NOMAD_ALLOC_ID'):
                 host_time_datapoint[0]['tags']['nomad_alloc_id'] = os.environ['NOMAD_ALLOC_ID']
 
-            values.append((n for n in host_time_datapoint))
-            values = itertools.chain(*values)
+            values.extend(host_time_datapoint)
 
-            ### Send results to the right output
+            ### Send results to all outputs
             try:
-                if self.output_type == 'stdout':
-                    utils.print_format_influxdb(values)
-                elif self.output_type == 'http':
-                    utils.post_format_influxdb(values, self.output_addr)
-                else:
-                    logger.warn('Collector: Output format unknown: {}'.format(self.output_type))
+                self.output.write(values, host=host)
             except Exception as ex:
-                logger.exception("Hit exception trying to post to influx")
+                logger.exception("Hit exception trying to send datapoints to the outputs")
 
             if host_reachable:
                 dev.close()
@@ -0,0 +1,108 @@
+import sys
+
+
+class DatapointBatch(object):
+    """
+    Compact representation of the datapoints collected for one host/command
+
+    The tags shared by all rows (facts and context of the host) are stored once
+    for the batch instead of being copied in each datapoint, each row only
+    holds its own tags and fields as tuples of (name, value) pairs.
+    Iterating over the batch returns the usual datapoint dicts, host tags
+    taking precedence over the tags of the row as before.
+    """
+    __slots__ = ('measurement', 'host_tags', 'timestamp', 'measurements', 'tags', 'fields', 'timestamps')
+
+    def __init__(self, measurement=None, host_tags=(), timestamp=None):
+        self.measurement = intern(measurement)
+        self.host_tags = tuple(host_tags)
+        self.timestamp = timestamp
+        self.measurements = []
+        self.tags = []
+        self.fields = []
+        ## Only allocated when a row has its own timestamp
+        self.timestamps = None
+
+    @classmethod
+    def from_datapoints(cls, datapoints, measurement=None, host_tags=(), timestamp=None):
+        """ Build a batch from datapoint dicts, datapoints without fields are skipped """
+        batch = cls(measurement=measurement, host_tags=host_tags, timestamp=timestamp)
+        for datapoint in datapoints:
+            if not datapoint['fields']:
+                continue
+            batch.append(
+                tuple((intern(k), intern(v)) for k, v in datapoint['tags'].items()),
+                tuple((intern(k), v) for k, v in datapoint['fields'].items()),
+                measurement=intern(datapoint.get('measurement')),
+                timestamp=datapoint.get('timestamp'),
+            )
+        return batch
+
+    def append(self, tags, fields, measurement=None, timestamp=None):
+        """ Add a row, tags and fields are tuples of (name, value) """
+        self.measurements.append(measurement)
+        self.tags.append(tags)
+        self.fields.append(fields)
+        if timestamp is not None and self.timestamps is None:
+            self.timestamps = [None] * (len(self.tags) - 1)
+        if self.timestamps is not None:
+            self.timestamps.append(timestamp)
+
+    def __len__(self):
+        return len(self.tags)
+
+    def rows(self):
+        """ Return (measurement, tags, fields, timestamp) for each row """
+        for i in range(len(self.tags)):
+            timestamp = self.timestamps[i] if self.timestamps is not None else None
+            yield (self.measurements[i] or self.measurement, self.tags[i], self.fields[i],
+                   self.timestamp if timestamp is None else timestamp)
+
+    def __iter__(self):
+        for measurement, tags, fields, timestamp in self.rows():
+            datapoint_tags = dict(tags)
+            datapoint_tags.update(self.host_tags)
+            yield {
+                'measurement': measurement,
+                'tags': datapoint_tags,
+                'fields': dict(fields),
+                'timestamp': timestamp,
+            }
+
+    def lines(self):
+        """ Return all rows in influxdb line protocol (str) """
+        host_keys = set(k for k, _ in self.host_tags)
+        host_tags = ','.join('{0}={1}'.format(k, v) for k, v in self.host_tags)
+
+        lines = []
+        for measurement, tags, fields, timestamp in self.rows():
+            if host_keys:
+                tags = [t for t in tags if t[0] not in host_keys]
+            tags_str = ','.join('{0}={1}'.format(k, v) for k, v in tags)
+            if host_tags:
+                tags_str = tags_str + ',' + host_tags if tags_str else host_tags
+            fields_str = ','.join('{0}={1}'.format(k, v) for k, v in fields)
+
+            if tags_str:
+                lines.append('{0},{1} {2} {3}'.format(measurement, tags_str, fields_str, timestamp))
+            else:
+                lines.append('{0} {1} {2}'.format(measurement, fields_str, timestamp))
+        return lines
+
+
+def host_tags(facts=None, context=None):
+    """ Return the tags shared by all datapoints of a host, context takes precedence over facts """
+    tags = dict(facts or {})
+    if context:
+        tags.update(context)
+    return tuple((intern(k), intern(v)) for k, v in tags.items())
+
+
+def intern(value):
+    """
+    Intern tag keys/values so that the same strings collected at every cycle
+    share the same object instead of being allocated for each datapoint
+    """
+    if type(value) is str:
+        return sys.intern(value)
+    return value
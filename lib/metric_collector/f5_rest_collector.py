@@ -3,6 +3,7 @@ import time
 # need to monkey patch this as this prevents the code from running in threads
 import f5.bigip as bigip
 bigip.HAS_SIGNAL = False
+from metric_collector import datapoint
 
 logger = logging.getLogger('f5_rest_collector')
 
@@ -20,7 +21,7 @@ class F5Collector(object):
         self.__is_connected = False
         self.parsers = parsers
         if context:
-            self.context = {k: v for i in context for k, v in i.items()}
+            self.context = dict(context)
         else:
             self.context = None
         self.facts = {}
@@ -92,17 +93,11 @@ class F5Collector(object):
 
         if datapoints is not None:
             measurement = self.parsers.get_measurement_name(input=command)
-            timestamp = time.time_ns()
-            for datapoint in datapoints:
-                if not datapoint['fields']:
-                    continue
-                if datapoint['measurement'] is None:
-                    datapoint['measurement'] = measurement
-                datapoint['tags'].update(self.facts)
-                if self.context:
-                    datapoint['tags'].update(self.context)
-                datapoint['timestamp'] = timestamp
-                yield datapoint
+            return datapoint.DatapointBatch.from_datapoints(
+                datapoints,
+                measurement=measurement,
+                host_tags=datapoint.host_tags(self.facts, self.context),
+                timestamp=time.time_ns())
 
         else:
             logger.warn('No parser found for command > %s', command)
@@ -1,16 +1,78 @@
 
+import functools
 import re
 import logging
+from collections import namedtuple
+
+### Hosts added, removed and changed (address, tags, context, device type) by an inventory update
+InventoryDiff = namedtuple('InventoryDiff', ['added', 'removed', 'changed'])
+
+### Tags without any of these characters are matched as plain strings, without regex
+REGEX_SPECIAL_CHARS = set('.^$*+?{}[]\\|()')
+
+
+def is_regex(tag):
+    return any(c in REGEX_SPECIAL_CHARS for c in tag)
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_tag(pattern, full_match=False):
+    if full_match:
+        pattern = r'^{tag}$'.format(tag=pattern)
+    return re.compile(pattern, re.IGNORECASE)
+
+
+def tag_search(pattern, value):
+    """ Same as re.search(pattern, value, re.IGNORECASE) """
+    if not is_regex(pattern):
+        return pattern.lower() in value.lower()
+    return compile_tag(pattern).search(value) is not None
+
+
+def tag_full_match(pattern, value):
+    """ Same as re.search('^<pattern>$', value, re.IGNORECASE) """
+    if not is_regex(pattern):
+        return pattern.lower() == value.lower()
+    return compile_tag(pattern, full_match=True).search(value) is not None
+
+class HostPlan(object):
+    """
+    Everything needed to collect a host, resolved once when the inventory is loaded
+    context is flattened as a tuple of (key, value), commands is a tuple of
+    (interval, commands) of all the commands of the host
+    """
+    __slots__ = ('name', 'address', 'device_type', 'tags', 'credential', 'context', 'commands')
+
+    def __init__(self, name, address, device_type, tags, credential, context, commands):
+        for attr, value in zip(self.__slots__, (name, address, device_type, tuple(tags), credential,
+                                                tuple(context), tuple(commands))):
+            object.__setattr__(self, attr, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('HostPlan is immutable')
+
+    def __repr__(self):
+        return 'HostPlan({}, {})'.format(self.name, self.address)
+
 
 class HostManager(object):
     """
     Manage the list of hosts
     Help identify what credential & commands needs to be used for each device
     """
-    def __init__(self, credentials, commands, log='info'):
+    def __init__(self, credentials, commands, log='info', parser_manager=None):
 
+        self.parser_manager = parser_manager
         self.commands = {}
         self.credentials = {}
+        self.hosts = {}
+        self.plans = {}
+
+        ### Inverted index {host tag: set of hosts} and results memoized until the next inventory update
+        self.tag_index = {}
+        self._target_hosts_cache = {}
+        self._target_commands_cache = {}
+        self._credentials_cache = {}
 
         ### -------------------------------------------------------------
         ### Check data format
@@ -153,7 +215,12 @@ class HostManager(object):
 
 
     def update_hosts(self, inventory):
-        self.hosts = {}
+        """
+        Replace the list of hosts, the new list is built aside and swapped at
+        the end so that collections in progress never see a partial inventory
+        Hosts that didn't change keep their entry, return an InventoryDiff
+        """
+        hosts = {}
         if not isinstance(inventory, dict):
             raise Exception("inventory must be a dictionnary of host")
         ### -------------------------------------------------------------
@@ -170,15 +237,15 @@ class HostManager(object):
                     self.log.warn('host: address is missing for %s, not supported, skipping' % host)
                     continue
 
-                self.hosts[host] = inventory[host]
+                hosts[host] = inventory[host]
 
-                if 'context' not in self.hosts[host]:
-                    self.hosts[host]['context'] = []
+                if 'context' not in hosts[host]:
+                    hosts[host]['context'] = []
 
             elif isinstance(inventory[host], str):
 
                 tags = inventory[host].split()
-                self.hosts[host] = {
+                hosts[host] = {
                     'tags': tags,
                     'address': host,
                     'context': []
@@ -187,6 +254,41 @@ class HostManager(object):
             else:
                 self.log.warn('host: format for %s not spported, skipping' % host)
 
+        previous = self.hosts
+        diff = InventoryDiff(
+            added=set(hosts) - set(previous),
+            removed=set(previous) - set(hosts),
+            changed=set(h for h in hosts if h in previous and hosts[h] != previous[h]),
+        )
+        for host in hosts:
+            if host in previous and host not in diff.changed:
+                hosts[host] = previous[host]
+
+        tag_index = {}
+        for host, params in hosts.items():
+            for tag in params['tags']:
+                tag_index.setdefault(tag, set()).add(host)
+
+        self.hosts = hosts
+        self.tag_index = tag_index
+        self._target_hosts_cache = {}
+        self._target_commands_cache = {}
+        self._credentials_cache = {}
+
+        ## Plans of unchanged hosts are kept, they are swapped with the new ones at once
+        plans = {}
+        for host in hosts:
+            if host in self.plans and host not in diff.changed:
+                plans[host] = self.plans[host]
+            else:
+                plans[host] = self.__build_plan__(host)
+        self.plans = plans
+        if previous:
+            self.log.info('host: inventory updated, %s added, %s removed, %s changed, %s unchanged',
+                          len(diff.added), len(diff.removed), len(diff.changed),
+                          len(hosts) - len(diff.added) - len(diff.changed))
+        return diff
+
 
     def get_target_hosts(self, tags=[]):
         """
@@ -196,18 +298,20 @@ class HostManager(object):
         if not isinstance(tags, list) or tags == []:
             return []
 
-        target_hosts = {}
-        for tag in tags:
-            self.log.debug('will find matching host for %s' % tag)
+        key = tuple(tags)
+        if key not in self._target_hosts_cache:
+            target_hosts = set()
+            for tag in tags:
+                self.log.debug('will find matching host for %s' % tag)
+
+                ## Match against each distinct tag of the inventory, not each host
+                for hosts_tag, hosts in self.tag_index.items():
+                    if tag_search(tag, hosts_tag):
+                        target_hosts.update(hosts)
 
-            for host in sorted(self.hosts.keys()):       
-                
-                self.log.debug('will check if %s is matching %s' % (host, tag))
-                for hosts_tag in self.hosts[host]['tags']:
-                    if re.search(tag, hosts_tag, re.IGNORECASE):
-                        target_hosts[host] = 1
+            self._target_hosts_cache[key] = sorted(target_hosts)
 
-        return sorted(target_hosts.keys())
+        return list(self._target_hosts_cache[key])
 
 
     def get_target_commands(self, host, tags=['.*']):
@@ -220,13 +324,18 @@ class HostManager(object):
 
         host_tags = self.hosts[host]['tags']
 
+        ## Hosts with the same tags share the same commands
+        key = (tuple(host_tags), tuple(tags))
+        if key in self._target_commands_cache:
+            return list(self._target_commands_cache[key])
+
         groups_matched = []
 
         ## First do a pass based on host tag and identify all group_command that matches
         for group_command, command in self.commands.items():
             for host_tag in host_tags:
                 for command_tag in command['tags']:
-                    if re.search( r'^{tag}$'.format(tag=host_tag), command_tag, re.IGNORECASE):
+                    if tag_full_match(host_tag, command_tag):
                         groups_matched.append(group_command)
 
         ## Second do a pass on command tag on the list of group_command that passed the previous check
@@ -234,10 +343,11 @@ class HostManager(object):
         for group_command in groups_matched:
             for tag in tags:
                 for command_tag in self.commands[group_command]['tags']:
-                    if re.search( r'^{tag}$'.format(tag=tag), command_tag, re.IGNORECASE):
+                    if tag_full_match(tag, command_tag):
                         final.add(group_command)
 
-        return [self.commands[group] for group in final]
+        self._target_commands_cache[key] = [self.commands[group] for group in final]
+        return list(self._target_commands_cache[key])
 
 
     def get_credentials(self, host):
@@ -245,16 +355,73 @@ class HostManager(object):
         if host not in self.hosts:
             return None
 
+        key = tuple(self.hosts[host]['tags'])
+        if key not in self._credentials_cache:
+            self._credentials_cache[key] = self.__find_credentials__(self.hosts[host]['tags'])
+
+        return self._credentials_cache[key]
+
+
+    def __find_credentials__(self, host_tags):
+
         for credential in sorted(self.credentials.keys()):
-            for host_tag in self.hosts[host]['tags']:
+            for host_tag in host_tags:
                 for credential_tag in self.credentials[credential]['tags']:
                     self.log.debug('will check if %s is matching %s' % (host_tag,credential_tag))
-                    if re.search(host_tag, credential_tag, re.IGNORECASE):
+                    if tag_search(host_tag, credential_tag):
                         return self.credentials[credential]
 
         return None
                        
 
+    def __build_plan__(self, host):
+
+        params = self.hosts[host]
+        ## Dynamic inventories may set context to False/None when there is none
+        context = [(k, v) for i in params['context'] or [] for k, v in i.items()]
+
+        commands = {}
+        for command in self.get_target_commands(host):
+            commands.setdefault(command['interval_secs'], []).extend(command['commands'])
+
+        ## Resolve the parsers now so that missing parsers are reported once, at load time
+        if self.parser_manager:
+            for command in set(c for cmds in commands.values() for c in cmds):
+                if self.parser_manager.get_parser_for(command) is None:
+                    self.log.warn('host: no parser found for %s on %s' % (command, host))
+
+        return HostPlan(
+            name=host,
+            address=params['address'],
+            device_type=params.get('device_type', 'juniper'),
+            tags=params['tags'],
+            credential=self.get_credentials(host),
+            context=context,
+            commands=[(interval, tuple(cmds)) for interval, cmds in sorted(commands.items())],
+        )
+
+
+    def get_host_commands(self, host, tags=['.*']):
+        """
+        Return the commands of a host grouped by interval, {interval: [commands]}
+        Read from the HostPlan when all commands are selected (default)
+        """
+        if tags == ['.*'] and host in self.plans:
+            return {interval: list(cmds) for interval, cmds in self.plans[host].commands}
+
+        commands = {}
+        for command in self.get_target_commands(host, tags=tags) or []:
+            commands.setdefault(command['interval_secs'], []).extend(command['commands'])
+        return commands
+
+
+    def get_host_plan(self, host):
+        """
+        Return the HostPlan of a host, resolved when the inventory was loaded
+        """
+        return self.plans.get(host)
+
+
     def get_context(self, host):
 
         if host not in self.hosts:
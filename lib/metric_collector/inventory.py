@@ -0,0 +1,173 @@
+import importlib.util
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger('inventory')
+
+### Entry points group under which packages can register inventory plugins
+ENTRY_POINT_GROUP = 'metric_collector.inventory'
+ENTRY_POINT_PREFIX = 'plugin:'
+
+### Function a dynamic inventory script defines to be loaded in-process
+PLUGIN_FACTORY = 'inventory_plugin'
+
+INVENTORY_MEASUREMENT = 'metric_collector_inventory'
+
+_plugins = {}
+_plugins_lock = threading.Lock()
+
+
+def get_plugin(hosts_file):
+    """
+    Return the inventory plugin for hosts_file or None if it's not a plugin
+
+    An inventory plugin is an object with a generate_inventory() method that
+    returns the hosts as a dict, it's created by a factory that is either:
+      - registered as an entry point in the metric_collector.inventory group,
+        selected with 'plugin:<name>'
+      - a function inventory_plugin() defined in a python script
+
+    The plugin is created once and reused for every refresh of the inventory,
+    so that it can keep its state (HTTP sessions, caches...) between refreshes.
+    """
+    with _plugins_lock:
+        if hosts_file not in _plugins:
+            _plugins[hosts_file] = load_plugin(hosts_file)
+        return _plugins[hosts_file]
+
+
+def load_plugin(hosts_file):
+    """ Create the inventory plugin for hosts_file, None if it's not a plugin """
+    if hosts_file.startswith(ENTRY_POINT_PREFIX):
+        factory = load_entry_point(hosts_file[len(ENTRY_POINT_PREFIX):])
+    else:
+        factory = load_script(hosts_file)
+
+    if factory is None:
+        return None
+
+    plugin = factory()
+    logger.info('Using inventory plugin %s from %s', type(plugin).__name__, hosts_file)
+    return plugin
+
+
+def load_entry_point(name):
+    """ Return the factory registered as entry point under name """
+    ## importlib.metadata only exists from python 3.8
+    try:
+        import importlib.metadata as metadata
+    except ImportError:
+        try:
+            import importlib_metadata as metadata
+        except ImportError:
+            metadata = None
+
+    if metadata is not None:
+        entry_points = metadata.entry_points()
+        if hasattr(entry_points, 'select'):
+            entry_points = entry_points.select(group=ENTRY_POINT_GROUP, name=name)
+        else:
+            entry_points = [ep for ep in entry_points.get(ENTRY_POINT_GROUP, []) if ep.name == name]
+    else:
+        import pkg_resources
+        entry_points = pkg_resources.iter_entry_points(ENTRY_POINT_GROUP, name)
+
+    for entry_point in entry_points:
+        return entry_point.load()
+    raise ValueError('Inventory plugin {} not found in {} entry points'.format(name, ENTRY_POINT_GROUP))
+
+
+def load_script(path):
+    """
+    Return the inventory_plugin() function of a python script, None if the
+    file is not a python script or doesn't define it (it's then executed as
+    an external script)
+    """
+    if not path.endswith('.py') or not os.path.isfile(path):
+        return None
+
+    ## Only import scripts written to be imported, others may run their main at import
+    with open(path) as f:
+        if 'def {}('.format(PLUGIN_FACTORY) not in f.read():
+            return None
+
+    module_name = 'metric_collector_inventory_{}'.format(os.path.splitext(os.path.basename(path))[0])
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return getattr(module, PLUGIN_FACTORY)
+
+
+class InventoryCache(object):
+    """
+    Last known good inventory, kept on disk to be served while the inventory
+    is refreshed (stale-while-revalidate) or when it can't be imported
+
+    hosts and updated (time of the last successful import) are replaced
+    together, readers never see a partial update
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.hosts = None
+        self.updated = None
+        self.failures = 0
+
+    def load(self):
+        """ Load the inventory saved on disk, return the hosts or None """
+        try:
+            with open(self.path) as f:
+                cache = json.load(f)
+            hosts, updated = cache['hosts'], float(cache['updated'])
+        except (IOError, ValueError, KeyError, TypeError) as ex:
+            logger.info('Unable to load the inventory cache %s: %s', self.path, ex)
+            return None
+
+        if not isinstance(hosts, dict) or not hosts:
+            return None
+        self.hosts, self.updated = hosts, updated
+        return hosts
+
+    def update(self, hosts):
+        """ Record a successful import of the inventory and save it on disk """
+        self.hosts, self.updated = dict(hosts), time.time()
+        self.failures = 0
+
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({'updated': self.updated, 'hosts': self.hosts}, f, separators=(',', ':'))
+            os.replace(tmp_path, self.path)
+        except (IOError, OSError, TypeError, ValueError) as ex:
+            logger.error('Unable to save the inventory cache %s: %s', self.path, ex)
+
+    def failed(self):
+        """ Record a failed import, return the last known good hosts or None """
+        self.failures += 1
+        if self.hosts is None:
+            self.load()
+        return self.hosts
+
+    def get_age(self):
+        """ Seconds since the last successful import, None if there is none """
+        if self.updated is None:
+            return None
+        return max(time.time() - self.updated, 0)
+
+    def get_stats_datapoints(self):
+        age = self.get_age()
+        if age is None:
+            return []
+        return [{
+            'measurement': INVENTORY_MEASUREMENT,
+            'tags': {},
+            'fields': {
+                'age_sec': int(age),
+                'nbr_hosts': len(self.hosts),
+                'failed_refreshes': self.failures,
+            },
+            'timestamp': time.time_ns(),
+        }]
@@ -7,6 +7,7 @@ from jnpr.junos.exception import *
 from jnpr.junos.utils.start_shell import StartShell
 from lxml import etree
 import time
+from metric_collector import datapoint
 
 logger = logging.getLogger('netconf_collector')
 
@@ -36,7 +37,7 @@ class NetconfCollector():
     self.host = address
     self.hostname = host
     if context:
-        self.context = {k: v for i in context for k, v in i.items()}
+        self.context = dict(context)
     else:
         self.context = None
     self.__credential = credential
@@ -171,18 +172,11 @@ class NetconfCollector():
     if datapoints is not None:
 
       measurement = self.parsers.get_measurement_name(input=command)
-
-      timestamp = time.time_ns()
-      for datapoint in datapoints:
-        if not datapoint['fields']:
-            continue
-        if datapoint['measurement'] == None:
-          datapoint['measurement'] = measurement
-        datapoint['tags'].update(self.facts)
-        if self.context:
-          datapoint['tags'].update(self.context)
-        datapoint['timestamp'] = timestamp
-        yield datapoint
+      return datapoint.DatapointBatch.from_datapoints(
+        datapoints,
+        measurement=measurement,
+        host_tags=datapoint.host_tags(self.facts, self.context),
+        timestamp=time.time_ns())
 
     else:
       logger.warn('No parser found for command > %s',command)
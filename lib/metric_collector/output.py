@@ -0,0 +1,709 @@
+import importlib
+import logging
+import os
+import queue
+import random
+import re
+import requests
+import socket
+import struct
+import sys
+import threading
+import time
+import zlib
+from metric_collector import datapoint, spool
+
+logger = logging.getLogger('output')
+
+OUTPUTS = {}
+
+### Outputs registered by other modules, imported the first time they are used
+OUTPUT_MODULES = {
+    'prometheus': 'metric_collector.prometheus',
+}
+
+DEFAULT_OUTPUT_ADDR = {
+    'http': 'http://localhost:8186/write',
+    'udp': 'udp://localhost:8089',
+    'unix': 'unix:///tmp/telegraf.sock',
+    'file': 'metric_collector.out',
+    'prometheus-remote-write': 'http://localhost:9090/api/v1/write',
+    'log': 'metric_collector_log',
+    'prometheus': ':9273',
+}
+
+### Status codes for which sending a batch again is worth it
+HTTP_RETRY_STATUS = [429, 500, 502, 503, 504]
+PARSE_ERROR_LINE_REGEX = re.compile(r"unable to parse '(.*?)': ", re.IGNORECASE)
+PARSE_ERROR_LINE_NUMBER_REGEX = re.compile(r"\bline (\d+)\b")
+PARTIAL_WRITE_DROPPED_REGEX = re.compile(r"\bdropped=(\d+)")
+
+PROMETHEUS_INVALID_CHARS = re.compile(r'[^a-zA-Z0-9_]')
+
+### Largest UDP payload that fits in a 1500 bytes MTU (minus IPv4 and UDP headers)
+UDP_MAX_PAYLOAD = 1500 - 20 - 8
+
+
+def register_output(name):
+    """ Class decorator to register an output backend under a name """
+    def wrapper(cls):
+        cls.name = name
+        OUTPUTS[name] = cls
+        return cls
+    return wrapper
+
+
+def get_output_types():
+    """ Return the names of all output backends, including those not imported yet """
+    return sorted(set(OUTPUTS) | set(OUTPUT_MODULES))
+
+
+def create_output(output_type, addr=None, **kwargs):
+    """ Create an output backend from its name """
+    if output_type not in OUTPUTS and output_type in OUTPUT_MODULES:
+        importlib.import_module(OUTPUT_MODULES[output_type])
+    if output_type not in OUTPUTS:
+        raise ValueError('Output type {} not supported, must be one of {}'.format(
+            output_type, ', '.join(get_output_types())))
+    return OUTPUTS[output_type](addr or DEFAULT_OUTPUT_ADDR.get(output_type), **kwargs)
+
+
+class OutputBatch(object):
+    """
+    A batch of datapoints (usually all datapoints of a host) shared by all outputs
+    Each encoding of the batch is computed once, the first time an output needs it
+
+    datapoints can be a mix of DatapointBatch and datapoint dicts, consecutive
+    dicts are grouped in a DatapointBatch
+    """
+    __slots__ = ('batches', 'host', '_encoded', '_lock')
+
+    def __init__(self, datapoints, host=None):
+        self.batches = []
+        self.host = host
+        self._encoded = {}
+        self._lock = threading.Lock()
+
+        dicts = []
+        for item in datapoints or []:
+            if isinstance(item, datapoint.DatapointBatch):
+                if dicts:
+                    self.batches.append(datapoint.DatapointBatch.from_datapoints(dicts))
+                    dicts = []
+                self.batches.append(item)
+            else:
+                dicts.append(item)
+        if dicts:
+            self.batches.append(datapoint.DatapointBatch.from_datapoints(dicts))
+
+    def __len__(self):
+        return sum(len(b) for b in self.batches)
+
+    @property
+    def datapoints(self):
+        """ Iterate over all datapoints as dicts """
+        for batch in self.batches:
+            for dp in batch:
+                yield dp
+
+    def encode(self, encoding, encoder):
+        """ Return the batch encoded with encoder(datapoints), cached per encoding name """
+        if encoding not in self._encoded:
+            with self._lock:
+                if encoding not in self._encoded:
+                    self._encoded[encoding] = encoder(self.datapoints)
+        return self._encoded[encoding]
+
+    def lines(self):
+        """ Return the list of datapoints in influxdb line protocol (bytes) """
+        return self.encode('lines', lambda dps: [
+            line.encode() for batch in self.batches for line in batch.lines()
+        ])
+
+    def data(self):
+        """ Return all datapoints in influxdb line protocol, newline terminated """
+        ## Encode the lines first, encode() holds the lock while running the encoder
+        lines = self.lines()
+        return self.encode('data', lambda dps: b''.join(line + b'\n' for line in lines))
+
+
+class OutputStats(object):
+    """ Thread safe counters for the lines handled by an output """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {'delivered': 0, 'retried': 0, 'dropped': 0}
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def get(self):
+        with self._lock:
+            return dict(self.counters)
+
+
+class Output(object):
+    """
+    Base class for all output backends
+
+    An output receives OutputBatch objects with write(), write() is called from
+    the dedicated thread of the output so it can block without slowing down
+    collection or the other outputs
+    """
+    name = None
+
+    def __init__(self, addr=None, **kwargs):
+        self.addr = addr
+        self.stats = OutputStats()
+
+    def write(self, batch):
+        raise NotImplementedError()
+
+    def overflow(self, batch):
+        """ Called when the queue of the output is full, default is to drop the batch """
+        logger.warning('Output %s is not keeping up, dropping %s datapoints', self.name, len(batch))
+        self.stats.incr('dropped', len(batch))
+
+    def close(self):
+        return
+
+
+### ------------------------------------------------------------------------------
+### Output backends
+### ------------------------------------------------------------------------------
+@register_output('stdout')
+class StdoutOutput(Output):
+    """
+    Print all datapoints to STDOUT in influxdb format for Telegraf to pick them up
+
+    All lines of a batch (one host) are written at once, so they are never
+    interleaved with the ones of another host
+    """
+    _lock = threading.Lock()
+
+    def write(self, batch):
+        data = batch.data()
+        if not data:
+            return
+
+        with self._lock:
+            stdout = sys.stdout
+            buffer = getattr(stdout, 'buffer', None)
+            if buffer is None:
+                stdout.write(data.decode())
+                stdout.flush()
+            else:
+                ## Flush anything already written through the text layer to keep ordering
+                stdout.flush()
+                buffer.write(data)
+                buffer.flush()
+        self.stats.incr('delivered', len(batch))
+
+
+@register_output('http')
+class HttpOutput(Output):
+    """
+    Send all datapoints to an HTTP endpoint (Telegraf, InfluxDB) in influxdb format
+
+    If a spool is provided, batches that can't be delivered (or can't be queued)
+    are stored in it and replayed, a few at a time, once the endpoint is
+    accepting data again
+    """
+
+    def __init__(self, addr=None, spool=None, batch_size=1000, retries=3, backoff=0.5, max_backoff=10,
+                 timeout=5, **kwargs):
+        super().__init__(addr, **kwargs)
+        self.spool = spool
+        self.batch_size = batch_size
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.session = requests.session()
+
+    def write(self, batch):
+        lines = batch.lines()
+        nbr_failed = 0
+        for i in range(0, len(lines), self.batch_size):
+            remaining = self.post(b'\n'.join(lines[i:i + self.batch_size]))
+            if remaining:
+                nbr_failed += 1
+                if self.spool is not None:
+                    self.spool.append(b'\n'.join(remaining))
+                    self.stats.incr('spooled', len(remaining))
+
+        if self.spool is not None and nbr_failed == 0:
+            self.spool.replay(self.replay)
+
+        logger.debug('Sent %s datapoints to: %s', len(lines), self.addr)
+
+    def replay(self, data):
+        """
+        Send a batch from the spool, return True once it can be removed from the spool
+        If some lines have been dropped on the way, only the remaining ones are spooled again
+        """
+        remaining = self.post(data)
+        if not remaining:
+            return True
+        elif len(remaining) < data.count(b'\n') + 1:
+            self.spool.append(b'\n'.join(remaining))
+            return True
+        return False
+
+    def overflow(self, batch):
+        if self.spool is None:
+            return super().overflow(batch)
+        self.spool.append(b'\n'.join(batch.lines()))
+        self.stats.incr('spooled', len(batch))
+
+    def post(self, data):
+        """
+        Post a batch of lines (bytes)
+
+        - 5xx, 429 and connection errors are retried with an exponential backoff
+        - 400 means some lines were rejected by the server, only these are dropped
+        - other 4xx will never succeed, the batch is dropped
+        Return the list of lines that couldn't be delivered after all retries
+        (empty if the batch has been dealt with)
+        """
+        lines = data.split(b'\n')
+        for attempt in range(0, self.retries + 1):
+
+            try:
+                resp = self.session.post(self.addr, data=b'\n'.join(lines), timeout=self.timeout)
+                status_code = resp.status_code
+            except requests.exceptions.RequestException as ex:
+                logger.warning('Failed to send datapoint to influx: %s', ex)
+                resp = None
+                status_code = None
+
+            if status_code in [200, 201, 204]:
+                self.stats.incr('delivered', len(lines))
+                return []
+
+            elif status_code == 400:
+                error = get_error_message(resp)
+                rejected = find_rejected_lines(error, lines)
+
+                ## With a partial write, all other lines have already been accepted
+                if 'partial write' in error:
+                    match = PARTIAL_WRITE_DROPPED_REGEX.search(error)
+                    nbr_dropped = min(len(lines), max(len(rejected), int(match.group(1)) if match else 0))
+                    logger.warning('Influx partial write, %s line(s) dropped: %s', nbr_dropped, error)
+                    self.stats.incr('dropped', nbr_dropped)
+                    self.stats.incr('delivered', len(lines) - nbr_dropped)
+                    return []
+
+                if not rejected:
+                    logger.error('Influx rejected a batch of %s lines, dropping it: %s', len(lines), error)
+                    self.stats.incr('dropped', len(lines))
+                    return []
+
+                logger.warning('Influx rejected %s line(s), dropping them: %s', len(rejected), error)
+                self.stats.incr('dropped', len(rejected))
+                lines = [l for i, l in enumerate(lines) if i not in rejected]
+                if not lines:
+                    return []
+                continue
+
+            elif status_code is not None and status_code not in HTTP_RETRY_STATUS:
+                ## Sending it again (or spooling it) would only block the data behind it
+                logger.error('Influx refused a batch of %s lines (%s), dropping it: %s', len(lines),
+                             status_code, resp.text)
+                self.stats.incr('dropped', len(lines))
+                return []
+
+            if attempt < self.retries:
+                ## Full jitter, avoid all collector threads hammering the endpoint at the same time
+                delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+                logger.info('Retrying to send %s lines to %s in %.2fs [%s/%s]', len(lines), self.addr, delay,
+                            attempt + 1, self.retries)
+                self.stats.incr('retried', len(lines))
+                time.sleep(delay)
+
+        logger.warning('Failed to send datapoint to influx after %s retries', self.retries)
+        return lines
+
+    def close(self):
+        self.session.close()
+        if self.spool is not None:
+            self.spool.close()
+
+
+def find_rejected_lines(error, lines):
+    """
+    Find the index of the lines reported as invalid in an influxdb error message
+    InfluxDB 1.x quotes the line ("unable to parse '<line>'") while InfluxDB 2.x
+    reports its number ("line 3: ...")
+    """
+    rejected = set()
+    for line in PARSE_ERROR_LINE_REGEX.findall(error):
+        line = line.encode()
+        for i, l in enumerate(lines):
+            if l == line:
+                rejected.add(i)
+    ## Ignore the content of the quoted lines while looking for line numbers
+    error = PARSE_ERROR_LINE_REGEX.sub('', error)
+    for line_number in PARSE_ERROR_LINE_NUMBER_REGEX.findall(error):
+        if 0 < int(line_number) <= len(lines):
+            rejected.add(int(line_number) - 1)
+    return rejected
+
+
+def get_error_message(resp):
+    """ Extract the error message from an influxdb (1.x or 2.x) response """
+    try:
+        body = resp.json()
+        return body.get('error') or body.get('message') or resp.text
+    except ValueError:
+        return resp.text
+
+
+@register_output('udp')
+class UdpOutput(Output):
+    """
+    Send all datapoints to a UDP listener (Telegraf socket_listener, InfluxDB) in influxdb format
+    Lines are packed together in datagrams that fit in the MTU
+    """
+
+    def __init__(self, addr=None, max_payload=UDP_MAX_PAYLOAD, **kwargs):
+        super().__init__(addr, **kwargs)
+        self.max_payload = max_payload
+        host, port = strip_scheme(addr).rsplit(':', 1)
+        family, _, _, _, sockaddr = socket.getaddrinfo(host.strip('[]'), int(port), type=socket.SOCK_DGRAM)[0]
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+        self.sock.connect(sockaddr)
+
+    def write(self, batch):
+        nbr_datagrams = 0
+        for datagram in pack_lines(batch.lines(), self.max_payload):
+            nbr_lines = datagram.count(b'\n')
+            try:
+                self.sock.send(datagram)
+                nbr_datagrams += 1
+                self.stats.incr('delivered', nbr_lines)
+            except OSError as ex:
+                logger.warning('Failed to send datapoint to %s: %s', self.addr, ex)
+                self.stats.incr('dropped', nbr_lines)
+        logger.debug('Sent %s datagram(s) to: %s', nbr_datagrams, self.addr)
+
+    def close(self):
+        self.sock.close()
+
+
+def pack_lines(lines, max_size):
+    """
+    Group lines (bytes) into newline separated payloads no larger than max_size
+    A line longer than max_size is sent alone
+    """
+    payload = bytearray()
+    for line in lines:
+        if payload and len(payload) + len(line) + 1 > max_size:
+            yield bytes(payload)
+            payload = bytearray()
+        payload += line
+        payload += b'\n'
+    if payload:
+        yield bytes(payload)
+
+
+@register_output('unix')
+class UnixOutput(Output):
+    """
+    Send all datapoints over a unix stream socket (Telegraf socket_listener) in influxdb format
+    The connection is kept open between batches, each batch is written at once
+    """
+
+    def __init__(self, addr=None, **kwargs):
+        super().__init__(addr, **kwargs)
+        self.path = strip_scheme(addr)
+        self.sock = None
+
+    def write(self, batch):
+        data = batch.data()
+        if not data:
+            return
+
+        for i in range(0, 2):
+            try:
+                if self.sock is None:
+                    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    self.sock.connect(self.path)
+                self.sock.sendall(data)
+                self.stats.incr('delivered', len(batch))
+                break
+            except OSError as ex:
+                ## The listener may have been restarted, reconnect once
+                self.close()
+                if i == 1:
+                    logger.warning('Failed to send datapoint to %s: %s', self.addr, ex)
+                    self.stats.incr('dropped', len(batch))
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+@register_output('file')
+class FileOutput(Output):
+    """ Append all datapoints to a file in influxdb format """
+
+    def __init__(self, addr=None, **kwargs):
+        super().__init__(addr, **kwargs)
+        self.file = open(strip_scheme(addr), 'ab')
+
+    def write(self, batch):
+        self.file.write(batch.data())
+        self.file.flush()
+        self.stats.incr('delivered', len(batch))
+
+    def close(self):
+        self.file.close()
+
+
+@register_output('log')
+class LogOutput(Output):
+    """
+    Local stand-in for a Kafka topic
+
+    Batches are appended to a directory of partitions, the partition is selected
+    by hashing the host so all data of a host stay ordered in the same partition.
+    Each partition is a spool (size capped append-only segments) that a consumer
+    can read with Spool.replay()
+    """
+
+    def __init__(self, addr=None, partitions=4, max_size=512*1024*1024, **kwargs):
+        super().__init__(addr, **kwargs)
+        directory = strip_scheme(addr)
+        self.partitions = [
+            spool.Spool(os.path.join(directory, 'partition-{}'.format(i)), max_size=max_size // partitions)
+            for i in range(0, partitions)
+        ]
+
+    def write(self, batch):
+        partition = zlib.crc32((batch.host or '').encode()) % len(self.partitions)
+        self.partitions[partition].append(batch.data())
+        self.stats.incr('delivered', len(batch))
+
+    def close(self):
+        for partition in self.partitions:
+            partition.close()
+
+
+@register_output('prometheus-remote-write')
+class PrometheusRemoteWriteOutput(Output):
+    """
+    Send all datapoints to a Prometheus remote write endpoint
+
+    Each field becomes a serie named <measurement>_<field> with the tags as labels,
+    non numeric values are ignored
+    """
+
+    def __init__(self, addr=None, timeout=5, **kwargs):
+        super().__init__(addr, **kwargs)
+        self.timeout = timeout
+        self.session = requests.session()
+        self.session.headers.update({
+            'Content-Encoding': 'snappy',
+            'Content-Type': 'application/x-protobuf',
+            'X-Prometheus-Remote-Write-Version': '0.1.0',
+        })
+
+    def write(self, batch):
+        data = batch.encode(self.name, encode_remote_write)
+        if not data:
+            return
+        try:
+            resp = self.session.post(self.addr, data=data, timeout=self.timeout)
+        except requests.exceptions.RequestException as ex:
+            logger.warning('Failed to send datapoint to %s: %s', self.addr, ex)
+            self.stats.incr('dropped', len(batch))
+            return
+        if resp.status_code // 100 != 2:
+            logger.warning('Failed to send datapoint to %s (%s): %s', self.addr, resp.status_code, resp.text)
+            self.stats.incr('dropped', len(batch))
+            return
+        self.stats.incr('delivered', len(batch))
+
+    def close(self):
+        self.session.close()
+
+
+def prometheus_metric_name(measurement, field):
+    """ Build a valid prometheus metric name from a measurement and a field name """
+    return prometheus_label_name('{}_{}'.format(measurement, field))
+
+
+def prometheus_label_name(name):
+    """ Build a valid prometheus label name, it can't start with a digit """
+    name = PROMETHEUS_INVALID_CHARS.sub('_', name)
+    if not name or name[0].isdigit():
+        name = '_' + name
+    return name
+
+
+def to_float(value):
+    """ Return the value as a float or None if it's not a number """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def encode_remote_write(datapoints):
+    """
+    Encode datapoints into a snappy compressed prometheus WriteRequest (protobuf)
+    """
+    timeseries = []
+    for datapoint in datapoints:
+        tags = {}
+        for k, v in datapoint['tags'].items():
+            ## After sanitization 2 tags can end up with the same name, keep the first one
+            tags.setdefault(prometheus_label_name(str(k)), str(v))
+        timestamp_ms = int(datapoint['timestamp']) // 1000000
+        for field, value in datapoint['fields'].items():
+            value = to_float(value)
+            if value is None:
+                continue
+            serie_labels = dict(tags)
+            serie_labels['__name__'] = prometheus_metric_name(datapoint['measurement'], field)
+            serie = b''.join(
+                _pb_bytes(1, _pb_bytes(1, name.encode()) + _pb_bytes(2, label.encode()))
+                for name, label in sorted(serie_labels.items())
+            )
+            sample = b'\x09' + struct.pack('<d', value) + b'\x10' + _pb_varint(timestamp_ms)
+            serie += _pb_bytes(2, sample)
+            timeseries.append(_pb_bytes(1, serie))
+
+    if not timeseries:
+        return b''
+    return snappy_compress_literal(b''.join(timeseries))
+
+
+def _pb_varint(value):
+    data = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            data.append(byte | 0x80)
+        else:
+            data.append(byte)
+            return bytes(data)
+
+
+def _pb_bytes(field_number, value):
+    """ Encode a length delimited protobuf field """
+    return _pb_varint(field_number << 3 | 2) + _pb_varint(len(value)) + value
+
+
+def snappy_compress_literal(data):
+    """
+    Frame data as a valid snappy block made only of literals
+    The payload is not compressed but any snappy decoder can read it,
+    which avoids depending on a native snappy library
+    """
+    out = bytearray(_pb_varint(len(data)))
+    for i in range(0, len(data), 65536):
+        chunk = data[i:i + 65536]
+        length = len(chunk) - 1
+        if length < 60:
+            out.append(length << 2)
+        elif length < 256:
+            out.append(60 << 2)
+            out.append(length)
+        else:
+            out.append(61 << 2)
+            out += struct.pack('<H', length)
+        out += chunk
+    return bytes(out)
+
+
+def strip_scheme(addr):
+    """ Remove the <scheme>:// in front of an address """
+    return addr.split('://', 1)[1] if '://' in addr else addr
+
+
+### ------------------------------------------------------------------------------
+### Fan-out
+### ------------------------------------------------------------------------------
+class QueuedOutput(threading.Thread):
+    """ Run an output in its own thread, fed by its own bounded queue """
+
+    def __init__(self, output, queue_size=1000):
+        super().__init__(daemon=True)
+        self.name = 'Output-{}'.format(output.name)
+        self.output = output
+        self.queue = queue.Queue(maxsize=queue_size)
+
+    def put(self, batch):
+        try:
+            self.queue.put_nowait(batch)
+        except queue.Full:
+            self.output.overflow(batch)
+
+    def run(self):
+        while True:
+            batch = self.queue.get()
+            try:
+                if batch is None:
+                    return
+                self.output.write(batch)
+            except Exception:
+                logger.exception('Output %s: hit exception while sending datapoints', self.output.name)
+            finally:
+                self.queue.task_done()
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+        self.output.close()
+
+
+class OutputManager(object):
+    """
+    Send the same batch of datapoints to one or multiple outputs
+
+    Each output has its own queue and thread, a slow output doesn't slow down
+    collection or the other outputs
+    """
+
+    def __init__(self, outputs, queue_size=1000):
+        self.outputs = [QueuedOutput(o, queue_size=queue_size) for o in outputs]
+        for o in self.outputs:
+            o.start()
+
+    def write(self, datapoints, host=None):
+        batch = OutputBatch(datapoints, host=host)
+        if not batch:
+            return
+        for o in self.outputs:
+            o.put(batch)
+
+    def get_stats_datapoints(self, tags=None):
+        """ Return one datapoint per output with its counters """
+        datapoints = []
+        for o in self.outputs:
+            datapoint = {
+                'measurement': 'metric_collector_output_stats',
+                'tags': {'output_type': o.output.name, 'output_addr': o.output.addr or 'none'},
+                'fields': o.output.stats.get(),
+                'timestamp': time.time_ns(),
+            }
+            datapoint['fields']['queue_size'] = o.queue.qsize()
+            if tags:
+                datapoint['tags'].update(tags)
+            datapoints.append(datapoint)
+        return datapoints
+
+    def flush(self):
+        """ Wait for all queued datapoints to be sent, outputs keep running """
+        for o in self.outputs:
+            o.queue.join()
+
+    def close(self):
+        """ Wait for all queued datapoints to be sent and stop all outputs """
+        for o in self.outputs:
+            o.close()
@@ -1,5 +1,7 @@
+import functools
 import logging
 import pprint
+import sys
 import os
 import yaml
 from lxml import etree
@@ -17,11 +19,16 @@ pp = pprint.PrettyPrinter(indent=4)
 ## Pyez is not fully supported, need to work on that 
 SUPPORTED_PARSER_TYPE = ['xml', 'textfsm', 'pyez', 'regex', 'json']
 
+## Number of tag values kept in the cache of cleanup_tag
+CLEANUP_TAG_CACHE_SIZE = 65536
+
 class ParserManager:
 
   def __init__( self, parser_dirs=[], default_parser_dir = '../../parsers' ):
 
     self.parsers = {}
+    ## Parser found for each command, the list of parsers only changes when a parser is added
+    self.__parser_for = {}
 
     self.nbr_regex_parsers = 0
     self.nbr_xml_parsers = 0
@@ -106,6 +113,13 @@ class ParserManager:
         self.__add_parser__( name=parser['name'], parser=parser )
 
   def __find_parser__( self, input=None ):
+
+    if input not in self.__parser_for:
+      self.__parser_for[input] = self.__search_parser__(input=input)
+
+    return self.__parser_for[input]
+
+  def __search_parser__( self, input=None ):
     """
     ## First check parser by name
     ## if nothing found, keep searching by type base on order defined in SUPPORTED_PARSER_TYPE
@@ -183,6 +197,7 @@ class ParserManager:
       self.nbr_json_parsers += 1 
     
     self.parsers[name] = parser
+    self.__parser_for = {}
 
     return True
 
@@ -672,9 +687,11 @@ class ParserManager:
       return value
 
   @staticmethod
+  @functools.lru_cache(maxsize=CLEANUP_TAG_CACHE_SIZE)
   def cleanup_tag( str_in ):
     """
     Cleanup a string to make sure it doesn't contain space
+    The same tags are seen at every cycle, results are cached and interned
     """
 
     tmp_str = str_in
@@ -683,7 +700,7 @@ class ParserManager:
     for char in forbidden_chars: 
       tmp_str = tmp_str.replace(char, "_")
 
-    return tmp_str
+    return sys.intern(str(tmp_str))
 
   @staticmethod
   def cleanup_xpath( xpath=None ):
@@ -0,0 +1,377 @@
+import logging
+import threading
+from metric_collector import datapoint
+
+logger = logging.getLogger('pipeline')
+
+STAGES = {}
+
+### Order in which the stages configured for a parser are applied
+STAGE_ORDER = ['cardinality', 'rate', 'aggregate', 'delta']
+
+CARDINALITY_MEASUREMENT = 'metric_collector_cardinality'
+
+
+def register_stage(name):
+    """ Class decorator to register a pipeline stage under a name """
+    def wrapper(cls):
+        cls.name = name
+        STAGES[name] = cls
+        return cls
+    return wrapper
+
+
+class Stage(object):
+    """
+    Base class for the processing stages applied to the datapoints of a command
+    between the collector and the outputs
+
+    A stage is configured by the key of the same name in the parser definition
+    and keeps a state per series across cycles. The state of a (host, command)
+    is rebuilt with the series seen in the last batch, so series that disappear
+    don't stay in memory.
+    """
+    name = None
+
+    def __init__(self, config=None):
+        self.config = config if isinstance(config, dict) else {}
+        self.states = {}
+
+    def process(self, key, batch):
+        """ Return a new DatapointBatch for a batch collected for key (host, command) """
+        previous = self.states.get(key, {})
+        states = {}
+        out = datapoint.DatapointBatch(batch.measurement, batch.host_tags, batch.timestamp)
+
+        for measurement, tags, fields, timestamp in batch.rows():
+            series = (measurement, tags)
+            result = self.process_series(fields, timestamp, previous.get(series))
+            fields, states[series] = result[:2]
+            if len(result) > 2:
+                timestamp = result[2]
+            if fields:
+                out.append(tags, fields, measurement=measurement,
+                           timestamp=timestamp if timestamp != batch.timestamp else None)
+
+        self.states[key] = states
+        return out
+
+    def process_series(self, fields, timestamp, state):
+        """
+        Process the fields of one series, state is what was returned for the
+        same series on the previous cycle (None the first time)
+        Return (fields to emit, new state) or (fields to emit, new state, timestamp)
+        to emit the fields with another timestamp than the one of the batch
+        """
+        raise NotImplementedError()
+
+
+@register_stage('cardinality')
+class CardinalityStage(Stage):
+    """
+    Enforce a budget of series per host and measurement
+
+      cardinality:
+        max-series: 1000      # per host and measurement, default 1000
+        action: drop          # drop or aggregate the series above the budget
+        expire: 10            # cycles after which a series not collected frees its slot
+        top: 3                # number of tags reported as top offenders
+
+    Series are admitted until the budget is reached, a series over the budget
+    is dropped or merged (numeric fields summed) in a single series whose tags
+    are all set to 'other'. Each cycle a metric_collector_cardinality point is
+    emitted per measurement with the number of series, the budget and the
+    number of series rejected, and one per tag having the most distinct values
+    (top offenders).
+    """
+
+    def __init__(self, config=None):
+        super().__init__(config)
+        self.max_series = int(self.config.get('max-series', 1000))
+        self.action = self.config.get('action', 'drop')
+        self.expire = int(self.config.get('expire', 10))
+        self.top = int(self.config.get('top', 3))
+
+    def process(self, key, batch):
+        ## state per measurement is [cycle, {series tags: last cycle seen}, rejected on the previous cycle]
+        states = self.states.setdefault(key, {})
+        out = datapoint.DatapointBatch(batch.measurement, batch.host_tags, batch.timestamp)
+        rejected = {}
+        others = {}
+        tag_values = {}
+
+        for measurement, tags, fields, timestamp in batch.rows():
+            if measurement not in tag_values:
+                state = self.new_cycle(states, measurement)
+                tag_values[measurement] = {}
+                rejected[measurement] = 0
+            else:
+                state = states[measurement]
+
+            for name, value in tags:
+                tag_values[measurement].setdefault(name, set()).add(value)
+
+            series = state[1]
+            if tags in series or len(series) < self.max_series:
+                series[tags] = state[0]
+            else:
+                rejected[measurement] += 1
+                if self.action == 'aggregate':
+                    other = others.setdefault(measurement, ({}, {}))
+                    other[0].update((name, 'other') for name, _ in tags)
+                    for name, value in fields:
+                        number = to_number(value)
+                        if number is not None:
+                            other[1][name] = other[1].get(name, 0) + number
+                continue
+
+            out.append(tags, fields, measurement=measurement,
+                       timestamp=timestamp if timestamp != batch.timestamp else None)
+
+        for measurement, (tags, fields) in others.items():
+            out.append(tuple(tags.items()), tuple(fields.items()), measurement=measurement)
+
+        for measurement, values in tag_values.items():
+            state = states[measurement]
+            if rejected[measurement] and not state[2]:
+                logger.warning('[%s] %s: more than %s series, %s series %s',
+                               key[0], measurement, self.max_series, rejected[measurement],
+                               'aggregated' if self.action == 'aggregate' else 'dropped')
+            state[2] = rejected[measurement]
+
+            out.append((('measurement', measurement),),
+                       (('series', len(state[1])), ('max_series', self.max_series), ('rejected', rejected[measurement])),
+                       measurement=CARDINALITY_MEASUREMENT)
+            top = sorted(values.items(), key=lambda item: len(item[1]), reverse=True)[:self.top]
+            for name, tag_set in top:
+                out.append((('measurement', measurement), ('tag', name)), (('distinct_values', len(tag_set)),),
+                           measurement=CARDINALITY_MEASUREMENT)
+
+        return out
+
+    def new_cycle(self, states, measurement):
+        """ Start a new cycle for a measurement, series not seen for expire cycles are removed """
+        state = states.get(measurement)
+        if state is None:
+            state = states[measurement] = [0, {}, 0]
+            return state
+        state[0] += 1
+        deadline = state[0] - self.expire
+        state[1] = {tags: cycle for tags, cycle in state[1].items() if cycle >= deadline}
+        return state
+
+
+@register_stage('rate')
+class RateStage(Stage):
+    """
+    Compute the per second rate of monotonic counters from the previous sample
+    of the same series, the rate is emitted as <field>_rate
+
+      rate:
+        fields: [input-bytes, output-bytes]   # default all numeric fields
+        keep-counters: true                   # false to replace the counters by their rate
+        counter-bits: 64                      # handle wraps of 32 or 64 bits counters
+
+    When a counter decreases (wrap or reset/reboot of the device), the rate is
+    computed over the wrap if counter-bits is set and the result is plausible,
+    otherwise no rate is emitted for this cycle.
+    """
+
+    def __init__(self, config=None):
+        super().__init__(config)
+        fields = self.config.get('fields')
+        self.fields = set(fields) if fields else None
+        self.keep_counters = self.config.get('keep-counters', True)
+        self.suffix = self.config.get('suffix', '_rate')
+        bits = self.config.get('counter-bits')
+        self.counter_max = 2 ** int(bits) if bits else None
+
+    def get_delta(self, previous, value):
+        if value >= previous:
+            return value - previous
+        if self.counter_max and previous < self.counter_max:
+            delta = self.counter_max - previous + value
+            ## A reset looks like a wrap of almost the whole counter range
+            if delta < self.counter_max / 2:
+                return delta
+        return None
+
+    def process_series(self, fields, timestamp, state):
+        values = {}
+        emit = []
+        for name, value in fields:
+            counter = None
+            if self.fields is None or name in self.fields:
+                counter = to_number(value)
+            if counter is None:
+                emit.append((name, value))
+                continue
+
+            values[name] = counter
+            if self.keep_counters:
+                emit.append((name, value))
+
+            if state is None or name not in state[1] or timestamp is None:
+                continue
+            elapsed = (timestamp - state[0]) / 1e9
+            delta = self.get_delta(state[1][name], counter)
+            if elapsed > 0 and delta is not None:
+                emit.append((name + self.suffix, delta / elapsed))
+
+        return tuple(emit), (timestamp, values)
+
+
+@register_stage('aggregate')
+class AggregateStage(Stage):
+    """
+    Aggregate the samples of each series over a time window and emit one
+    point per window with <field>_min, <field>_max, <field>_mean and <field>_last
+
+      aggregate:
+        window: 60                  # seconds, default 60
+        functions: [max, mean]      # default min, max, mean, last
+        fields: [input-bps]         # default all numeric fields
+
+    Windows are aligned on the clock, the aggregated point of a window is
+    emitted with the timestamp of its last sample when the first sample of the
+    next window is collected. Non numeric fields are emitted with their last value.
+    """
+    FUNCTIONS = ['min', 'max', 'mean', 'last']
+
+    def __init__(self, config=None):
+        super().__init__(config)
+        self.window = int(float(self.config.get('window', 60)) * 10**9)
+        self.functions = self.config.get('functions') or self.FUNCTIONS
+        fields = self.config.get('fields')
+        self.fields = set(fields) if fields else None
+
+    def summarize(self, accumulators):
+        emit = []
+        for name, (minimum, maximum, total, count, last) in accumulators.items():
+            if not count:
+                emit.append((name, last))
+                continue
+            values = {'min': minimum, 'max': maximum, 'mean': total / count, 'last': last}
+            for function in self.functions:
+                emit.append(('{}_{}'.format(name, function), values[function]))
+        return tuple(emit)
+
+    def process_series(self, fields, timestamp, state):
+        window = (timestamp or 0) // self.window
+        emit = ()
+        emit_timestamp = timestamp
+
+        ## state is [window, timestamp of the last sample, {field: [min, max, sum, count, last]}]
+        if state is not None and state[0] != window:
+            emit, emit_timestamp = self.summarize(state[2]), state[1]
+            state = None
+        if state is None:
+            state = [window, timestamp, {}]
+        state[1] = timestamp
+
+        accumulators = state[2]
+        for name, value in fields:
+            number = None
+            if self.fields is None or name in self.fields:
+                number = to_number(value)
+            acc = accumulators.get(name)
+            if number is None:
+                if acc is None:
+                    accumulators[name] = [None, None, 0, 0, value]
+                else:
+                    acc[4] = value
+            elif acc is None or not acc[3]:
+                accumulators[name] = [number, number, number, 1, number]
+            else:
+                acc[0] = min(acc[0], number)
+                acc[1] = max(acc[1], number)
+                acc[2] += number
+                acc[3] += 1
+                acc[4] = number
+
+        return emit, state, emit_timestamp
+
+
+@register_stage('delta')
+class DeltaStage(Stage):
+    """
+    Emit a field only when its value changed since it was last emitted, or
+    every <heartbeat> cycles so that the series doesn't look stale
+
+      delta:
+        heartbeat: 10             # default 10 cycles
+        fields: [mtu, speed]      # default all fields
+
+    'delta: true' enables it for all fields with the default heartbeat
+    """
+
+    def __init__(self, config=None):
+        super().__init__(config)
+        self.heartbeat = int(self.config.get('heartbeat', 10))
+        fields = self.config.get('fields')
+        self.fields = set(fields) if fields else None
+
+    def process_series(self, fields, timestamp, state):
+        state = state or {}
+        new_state = {}
+        emit = []
+        for name, value in fields:
+            if self.fields is not None and name not in self.fields:
+                emit.append((name, value))
+                continue
+            last = state.get(name)
+            if last is not None and last[0] == value and last[1] + 1 < self.heartbeat:
+                new_state[name] = (value, last[1] + 1)
+            else:
+                new_state[name] = (value, 0)
+                emit.append((name, value))
+        return tuple(emit), new_state
+
+
+def to_number(value):
+    """ Return the value as a number or None if it's not numeric """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class Pipeline(object):
+    """
+    Apply the stages configured in the parser of each command to the
+    datapoints collected, a single instance is shared by all collector threads
+    """
+
+    def __init__(self, parser_manager):
+        self.parser_manager = parser_manager
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def get_stages(self, command):
+        """ Return the list of stages configured for a command, built once per command """
+        if command in self._stages:
+            return self._stages[command]
+
+        with self._lock:
+            if command not in self._stages:
+                stages = []
+                parser = self.parser_manager.get_parser_for(command)
+                config = parser['data']['parser'] if parser else {}
+                for name in STAGE_ORDER:
+                    if config.get(name):
+                        stages.append(STAGES[name](config[name]))
+                self._stages[command] = stages
+        return self._stages[command]
+
+    def process(self, host, command, batch):
+        for stage in self.get_stages(command):
+            batch = stage.process((host, command), batch)
+        return batch
@@ -0,0 +1,180 @@
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from metric_collector import output
+
+logger = logging.getLogger('prometheus')
+
+CONTENT_TYPE_TEXT = 'text/plain; version=0.0.4; charset=utf-8'
+CONTENT_TYPE_OPENMETRICS = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def render_labels(tags):
+    """ Render tags as prometheus labels, sorted by name """
+    labels = {}
+    for k, v in tags.items():
+        labels.setdefault(output.prometheus_label_name(str(k)), escape_label_value(v))
+    return ','.join('{}="{}"'.format(k, v) for k, v in sorted(labels.items()))
+
+
+def render_samples(datapoint, labels_str):
+    """ Return (<metric name>, <sample line>) for each numeric field of a datapoint """
+    for field, value in datapoint['fields'].items():
+        value = output.to_float(value)
+        if value is None:
+            continue
+        name = output.prometheus_metric_name(datapoint['measurement'], field)
+        if labels_str:
+            yield name, '{}{{{}}} {}'.format(name, labels_str, repr(value))
+        else:
+            yield name, '{} {}'.format(name, repr(value))
+
+
+def render_datapoints(datapoints):
+    """
+    Render datapoints as prometheus samples
+    Return a dict {<metric name>: [<sample line>, ...]}
+    """
+    metrics = {}
+    for datapoint in datapoints:
+        for name, line in render_samples(datapoint, render_labels(datapoint['tags'])):
+            metrics.setdefault(name, []).append(line)
+    return metrics
+
+
+class LatestValueStore(object):
+    """
+    Keep the latest sample of each series of each host, already rendered in
+    prometheus format
+
+    Samples are rendered when a host is updated (in the output thread), a
+    scrape only concatenates the rendered lines of all hosts. Samples are
+    merged per series (measurement, labels) and metric: a batch only replaces
+    the samples it contains, so fields or series not sent again (delta stage,
+    several writers sharing the same host) keep their last value. A sample not
+    updated for max_age seconds is removed, it must be larger than the delta
+    heartbeat of the parsers.
+    """
+
+    def __init__(self, max_age=600):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        ## {host: {(measurement, labels): {metric name: (updated, line)}}}
+        self._hosts = {}
+
+    def update(self, host, datapoints):
+        """ Replace the samples present in datapoints for a host """
+        now = time.monotonic()
+        rendered = {}
+        for datapoint in datapoints:
+            labels_str = render_labels(datapoint['tags'])
+            samples = rendered.setdefault((datapoint['measurement'], labels_str), {})
+            for name, line in render_samples(datapoint, labels_str):
+                samples[name] = (now, line)
+
+        with self._lock:
+            ## Copy on write, a scrape in progress keeps using the previous version
+            series = dict(self._hosts.get(host, {}))
+            for key, samples in rendered.items():
+                if key in series:
+                    samples = dict(series[key], **samples)
+                series[key] = samples
+            self._hosts[host] = series
+
+    def remove(self, host):
+        with self._lock:
+            self._hosts.pop(host, None)
+
+    def expire(self):
+        """ Remove the samples not updated for max_age, and the series/hosts left empty """
+        deadline = time.monotonic() - self.max_age
+        with self._lock:
+            for host, series in list(self._hosts.items()):
+                if all(updated >= deadline for samples in series.values() for updated, _ in samples.values()):
+                    continue
+                kept = {}
+                for key, samples in series.items():
+                    samples = {name: sample for name, sample in samples.items() if sample[0] >= deadline}
+                    if samples:
+                        kept[key] = samples
+                if kept:
+                    self._hosts[host] = kept
+                else:
+                    del self._hosts[host]
+
+    def render(self, openmetrics=False):
+        """ Return the samples of all hosts, grouped by metric """
+        self.expire()
+        with self._lock:
+            hosts = list(self._hosts.values())
+
+        metrics = {}
+        for series in hosts:
+            for samples in series.values():
+                for name, (_, line) in samples.items():
+                    metrics.setdefault(name, []).append(line)
+
+        out = []
+        for name in sorted(metrics):
+            out.append('# TYPE {} {}'.format(name, 'unknown' if openmetrics else 'untyped'))
+            out.extend(metrics[name])
+        if openmetrics:
+            out.append('# EOF')
+        return ('\n'.join(out) + '\n').encode()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    store = None
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        openmetrics = 'application/openmetrics-text' in self.headers.get('Accept', '')
+        body = self.store.render(openmetrics=openmetrics)
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE_OPENMETRICS if openmetrics else CONTENT_TYPE_TEXT)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+@output.register_output('prometheus')
+class PrometheusOutput(output.Output):
+    """
+    Expose the latest datapoints of each host on an HTTP /metrics endpoint for prometheus to scrape
+    addr is the address to listen on, [<host>]:<port>, samples not updated
+    for max_age seconds are removed
+    """
+
+    def __init__(self, addr=None, max_age=600, **kwargs):
+        super().__init__(addr, **kwargs)
+        host, port = output.strip_scheme(addr).rsplit(':', 1)
+        self.store = LatestValueStore(max_age=max_age)
+        handler = type('Handler', (MetricsHandler,), {'store': self.store})
+        self.server = ThreadingHTTPServer((host.strip('[]') or '0.0.0.0', int(port)), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        logger.info('Serving prometheus metrics on http://%s:%s/metrics', *self.server.server_address[:2])
+
+    def write(self, batch):
+        ## Batches without host (worker/output stats) share the same entry, samples
+        ## are merged per measurement and labels so that writers don't replace each other
+        self.store.update(batch.host or '', batch.datapoints)
+        self.stats.incr('delivered', len(batch))
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
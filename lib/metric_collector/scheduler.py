@@ -1,221 +1,245 @@
+import concurrent.futures
+import heapq
+import itertools
 import logging
-import queue
 import threading
 import time
 import os
-from metric_collector import host_manager, parser_manager, collector, utils
+import zlib
+from metric_collector import host_manager, parser_manager, collector
 
 logger = logging.getLogger('scheduler')
 
+def get_phase_offset(host, interval):
+    ''' Return the start offset (secs) of a host in an interval, derived from its name so that
+        hosts are spread evenly over the interval and keep the same offset across restarts
+    '''
+    return (zlib.crc32(host.encode()) % (int(interval * 1000) or 1)) / 1000.0
+
+
+class ScheduledJob(object):
+    ''' Commands run on a host at the same interval '''
+    __slots__ = ('host', 'interval', 'commands', 'next_run', 'running', 'removed',
+                 'missed_cycles', 'execution_time')
+
+    def __init__(self, host, interval, commands, next_run):
+        self.host = host
+        self.interval = interval
+        self.commands = commands
+        self.next_run = next_run
+        self.running = False
+        self.removed = False
+        self.missed_cycles = 0
+        self.execution_time = 0
+
+
 class Scheduler:
+    ''' Run the commands of each host at their interval
+
+        The next run of every (host, interval) is kept in a heap, a single thread
+        waits for the next due job and hands it over to a pool of collector threads
+        shared by all intervals. Jobs run at a fixed rate on a monotonic clock, each
+        host at its phase offset in the interval. A run that is due while the previous
+        one is still running (or waiting for a collector thread) is skipped and
+        counted in missed_cycles.
+    '''
 
-    def __init__(self, creds_conf, cmds_conf, parsers_dir, output_type, output_addr,
+    def __init__(self, creds_conf, cmds_conf, parsers_dir, output,
                  max_worker_threads=1, use_threads=True, num_threads_per_worker=10,
-                 collector_timeout=30):
-        self.workers = {}
-        self.working = set()
-        self.host_mgr = host_manager.HostManager(credentials=creds_conf, commands=cmds_conf)
+                 collector_timeout=30, output_stats_interval=60, cost_store=None):
         self.parser_mgr = parser_manager.ParserManager(parser_dirs=parsers_dir)
-        self.collector = collector.Collector(self.host_mgr, self.parser_mgr, output_type, output_addr,
-            timeout=collector_timeout)
-        self.max_worker_threads = max_worker_threads
-        self.output_type = output_type
-        self.output_addr = output_addr
-        self.use_threads = use_threads
-        self.num_threads_per_worker = num_threads_per_worker
-        # default worker that is started if there are no hosts to schedule
-        self.default_worker = Worker(
-            120, self.collector, self.output_type, self.output_addr,
-            self.use_threads, self.num_threads_per_worker)
-        self.default_worker.set_name('Default-120sec')
-
-    def _get_worker(self, interval, refresh=False):
-        ''' Returns a worker thread for a given interval. If max_worker_threads is
-            reached, then it cycles through the existing workers
-        '''
-        interval_workers = self.workers.get(interval, [])
-        if refresh and interval_workers and not isinstance(interval_workers, list):
-            return next(interval_workers)
-        if len(interval_workers) == self.max_worker_threads:
-            if isinstance(interval_workers, list):
-                interval_workers = utils.Cycle(interval_workers)
-                self.workers[interval] = interval_workers
-            return next(interval_workers)
-        new_worker = Worker(interval, self.collector, self.output_type, self.output_addr,
-                            self.use_threads, self.num_threads_per_worker)
-        new_worker.set_name('Worker-{}sec-{}'.format(interval, len(interval_workers) + 1))
-        interval_workers.append(new_worker)
-        self.workers[interval] = interval_workers
-        return new_worker
+        self.host_mgr = host_manager.HostManager(credentials=creds_conf, commands=cmds_conf,
+                                                 parser_manager=self.parser_mgr)
+        self.collector = collector.Collector(self.host_mgr, self.parser_mgr, output,
+            timeout=collector_timeout, cost_store=cost_store)
+        self.output = output
+        self.output_stats_interval = output_stats_interval
+        self.output_stats_thread = None
+        ## Other objects with a get_stats_datapoints() method reported with the scheduler stats
+        self.stats_sources = []
+        self.nbr_threads = max_worker_threads * num_threads_per_worker if use_threads else 1
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.nbr_threads, thread_name_prefix='collector')
+        self.jobs = {}
+        self._cmd_tags = None
+        self._heap = []
+        self._seq = itertools.count()
+        self._run = True
+        self._cond = threading.Condition()
 
     def _get_hostcmds(self, hosts, cmd_tags):
         ''' Group all the hosts by the intervals/commands to be run on them '''
         hostcmds = {}
         for host in hosts:
-            target_commands = self.host_mgr.get_target_commands(host, tags=cmd_tags)
-            for cmd in target_commands:
-                cmds_per_interval = hostcmds.setdefault(host, {}).setdefault(cmd['interval_secs'], [])
-                cmds_per_interval += cmd['commands']
+            interval_cmds = self.host_mgr.get_host_commands(host, tags=cmd_tags)
+            if interval_cmds:
+                hostcmds[host] = interval_cmds
         return hostcmds
 
-    def init_workers(self):
-        for worker in self.working:
-            worker.init()
-
     def add_hosts(self, hosts_conf, host_tags=None, cmd_tags=None, refresh=False):
-        '''  Create worker threads per interval and round-robin the hosts amongst them '''
+        '''  Schedule the commands of all hosts
+
+            The new schedule is built aside and diffed against the current one, only the
+            jobs of hosts/intervals added or removed are touched and the lock is only held
+            to swap them, collections in progress are not disturbed
+        '''
         if not hosts_conf:
             logger.error('Scheduler: No hosts')
             return
-        self.init_workers()
         # update host manager
-        self.host_mgr.update_hosts(hosts_conf)
+        diff = self.host_mgr.update_hosts(hosts_conf)
         hosts = self.host_mgr.get_target_hosts(tags=host_tags or ['.*'])
         logger.debug('The following hosts are being selected: %s', hosts)
         tags = cmd_tags or ['.*']
-        hostcmds = self._get_hostcmds(hosts, tags)
-        if not hostcmds:
-            logger.error('Scheduler: No commands found to collect')
-            return
+
+        # Only resolve the commands of new or changed hosts, the others keep their jobs
+        schedule = {}
+        scheduled = set()
+        if tags == self._cmd_tags:
+            for key, job in list(self.jobs.items()):
+                if key[0] not in diff.changed:
+                    schedule[key] = job.commands
+                    scheduled.add(key[0])
+        self._cmd_tags = tags
+        hostcmds = self._get_hostcmds([h for h in hosts if h not in scheduled], tags)
         for host, interval_cmds in hostcmds.items():
             for interval, cmds in interval_cmds.items():
-                next_worker = self._get_worker(interval, refresh=refresh)
-                next_worker.add_host(host, cmds)
-                self.working.add(next_worker)
-        if refresh:
-            # start any new threads since last cycle
-            self.start()
-
-    def start(self):
-        ''' Start all worker threads and block until done '''
-        if len(self.working) == 0:
-            self.working.add(self.default_worker)
-        started = []
-        for worker in self.working:
-            if not worker.isAlive():
-                worker.start()
-                started.append(worker)
-        for interval, workers in self.workers.items():
-            if isinstance(workers, list):
-                self.workers[interval] = utils.Cycle(workers)
-        for worker in started:
-            worker.join()
+                schedule[(host, interval)] = cmds
 
-    def stop(self):
-        ''' Stop all running worker threads '''
-        logging.info("Scheduler: Stopping all running workers")
-        for w in self.working:
-            w.stop()
-        self.workers = {}
-        self.working = set()
-
-
-class Worker(threading.Thread):
-    ''' Worker is responsible for running a set of commands per host at regular intervals
-        and dumping to output
-    '''
-
-    def __init__(self, interval, collector, output_type, output_addr, use_threads, num_collector_threads):
-        super().__init__()
-        self.setDaemon(True)
-        self.interval = interval
-        self.collector = collector
-        self.output_type = output_type
-        self.output_addr = output_addr
-        self.num_collector_threads = num_collector_threads
-        self.use_threads = use_threads
-        self.hostcmds = {}
-        self._run = True
-        self._lock = threading.Lock()
-
-    def set_name(self, name):
-        self.name = name
-
-    def stop(self):
-        self._run = False
-
-    def add_host(self, host, cmds):
-        with self._lock:
-            commands = self.hostcmds.setdefault(host, [])
-            commands += cmds
+        target_hosts = set(hosts)
+        schedule = {key: cmds for key, cmds in schedule.items() if key[0] in target_hosts}
+        if not schedule:
+            logger.error('Scheduler: No commands found to collect')
 
-    def init(self):
-        with self._lock:
-            self.hostcmds = {}
+        now = time.monotonic()
+        with self._cond:
+            jobs = {}
+            added = updated = 0
+            for key, cmds in schedule.items():
+                job = self.jobs.get(key)
+                if job is None:
+                    host, interval = key
+                    job = ScheduledJob(host, interval, cmds, now + get_phase_offset(host, interval))
+                    heapq.heappush(self._heap, (job.next_run, next(self._seq), job))
+                    added += 1
+                elif job.commands != cmds:
+                    # Picked up on the next run
+                    job.commands = cmds
+                    updated += 1
+                jobs[key] = job
+
+            removed = 0
+            for key, job in self.jobs.items():
+                if key not in jobs:
+                    job.removed = True
+                    removed += 1
+
+            self.jobs = jobs
+            self._cond.notify()
+
+        logger.info('Scheduler: %s hosts scheduled, %s jobs (%s added, %s removed, %s updated)',
+                    len(set(key[0] for key in jobs)), len(jobs), added, removed, updated)
+
+    def _dispatch(self, job):
+        ''' Send a due job to the collector threads and schedule its next run, must hold the lock '''
+        if job.running:
+            job.missed_cycles += 1
+            logger.warning('Scheduler: %s (%s secs) is still running, skipping this cycle', job.host, job.interval)
+        else:
+            job.running = True
+            self.executor.submit(self._run_job, job)
+
+        job.next_run += job.interval
+        now = time.monotonic()
+        if job.next_run < now:
+            # The scheduler itself was late, stay on the grid
+            missed = int((now - job.next_run) // job.interval) + 1
+            job.missed_cycles += missed
+            job.next_run += missed * job.interval
+        heapq.heappush(self._heap, (job.next_run, next(self._seq), job))
+
+    def _run_job(self, job):
+        time_start = time.monotonic()
+        try:
+            if not job.removed:
+                self.collector.collect('Interval-{}sec'.format(job.interval), host_cmds={job.host: job.commands})
+        except Exception:
+            logger.exception('Scheduler: hit exception while collecting %s', job.host)
+        finally:
+            job.execution_time = time.monotonic() - time_start
+            job.running = False
 
     def run(self):
-        ''' Main run loop '''
-        while True:
-            if not self._run:
-                return
-            self._lock.acquire()
-            logger.info('{}: Starting collection for {} hosts'.format(
-                self.name, len(self.hostcmds)))
-            hosts = list(self.hostcmds.keys())
-            time_start = time.time()
-            if self.use_threads:
-                target_hosts_lists = [
-                    hosts[x: x + int(len(hosts) / self.num_collector_threads + 1)]
-                        for x in range(
-                            0, len(hosts), int(len(hosts) / self.num_collector_threads + 1)
-                        )
-                ]       
-                jobs = []
-                for i, target_hosts_list in enumerate(target_hosts_lists, 1):
-                    logger.info('{}: Collector Thread-{} scheduled with following hosts: {}'.format(
-                        self.name, i, target_hosts_list))
-                    hostcmds = {}
-                    for host in target_hosts_list:
-                        hostcmds[host] = self.hostcmds[host]
-                    job = threading.Thread(target=self.collector.collect,
-                                           args=(self.name,),
-                                           kwargs={"host_cmds": hostcmds})
-                    job.start()
-                    jobs.append(job)
-
-                # Ensure all of the threads have finished
-                for j in jobs:
-                    j.join()
-
-            else:
-                # Execute everythings in the main thread
-                self.collector.collect(self.name, host_cmds=self.hostcmds)
-
-            time_end = time.time()
-            time_execution = time_end - time_start
-            worker_datapoint = [
-                {
-                    'measurement': collector.global_measurement_prefix + '_worker_stats',
-                    'tags': {'worker_name': self.name},
-                    'fields': {
-                        'execution_time_sec': "%.4f" % time_execution,
-                        'nbr_devices': len(self.hostcmds),
-                        'nbr_threads': self.num_collector_threads
-                    },
-                    'timestamp': time.time_ns(),
-
-                }
-            ]
+        ''' Main loop, wait for the next due job and dispatch it '''
+        with self._cond:
+            while self._run:
+                while self._heap and self._heap[0][2].removed:
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                delay = self._heap[0][0] - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                _, _, job = heapq.heappop(self._heap)
+                self._dispatch(job)
+
+    def get_stats_datapoints(self):
+        ''' Return one datapoint per interval with the state of its jobs '''
+        intervals = {}
+        with self._cond:
+            for job in self.jobs.values():
+                stats = intervals.setdefault(job.interval, {'hosts': set(), 'missed_cycles': 0, 'execution_time': 0})
+                stats['hosts'].add(job.host)
+                stats['missed_cycles'] += job.missed_cycles
+                stats['execution_time'] = max(stats['execution_time'], job.execution_time)
+
+        datapoints = []
+        for interval, stats in sorted(intervals.items()):
+            datapoint = {
+                'measurement': collector.global_measurement_prefix + '_worker_stats',
+                'tags': {'worker_name': 'Interval-{}sec'.format(interval)},
+                'fields': {
+                    'execution_time_sec': "%.4f" % stats['execution_time'],
+                    'nbr_devices': len(stats['hosts']),
+                    'nbr_threads': self.nbr_threads,
+                    'missed_cycles': stats['missed_cycles'],
+                },
+                'timestamp': time.time_ns(),
+            }
             if os.environ.get('NOMAD_JOB_NAME'):
-                worker_datapoint[0]['tags']['nomad_job_name'] = os.environ['NOMAD_JOB_NAME']
+                datapoint['tags']['nomad_job_name'] = os.environ['NOMAD_JOB_NAME']
             if os.environ.get('NOMAD_ALLOC_INDEX'):
-                worker_datapoint[0]['tags']['nomad_alloc_index'] = os.environ['NOMAD_ALLOC_INDEX']
+                datapoint['tags']['nomad_alloc_index'] = os.environ['NOMAD_ALLOC_INDEX']
             if os.environ.get('NOMAD_ALLOC_ID'):
-                worker_datapoint[0]['tags']['nomad_alloc_id'] = os.environ['NOMAD_ALLOC_ID']
+                datapoint['tags']['nomad_alloc_id'] = os.environ['NOMAD_ALLOC_ID']
+            datapoints.append(datapoint)
+        return datapoints
 
-
-            ### Send results to the right output
+    def _report_stats(self):
+        ''' Send the counters of the scheduler, the outputs and the stats sources periodically, once for the whole process '''
+        while True:
+            time.sleep(self.output_stats_interval)
             try:
-                if self.output_type == 'stdout':
-                    utils.print_format_influxdb(worker_datapoint)
-                elif self.output_type == 'http':
-                    utils.post_format_influxdb(worker_datapoint, self.output_addr)
-                else:
-                    logger.warn('{}: Output format unknown: {}'.format(self.name, self.output_type))
-            except Exception as ex:
-                logger.exception("Hit exception trying to post to influx")
-
-            logger.info('Worker {} took {} seconds to run'.format(self.name, time_execution))
-            self._lock.release()
-            # sleep until next interval
-            time.sleep(self.interval)
+                datapoints = self.get_stats_datapoints() + self.output.get_stats_datapoints()
+                for source in self.stats_sources:
+                    datapoints += source.get_stats_datapoints()
+                self.output.write(datapoints)
+            except Exception:
+                logger.exception("Hit exception trying to send scheduler/output stats")
+
+    def start(self):
+        ''' Run the scheduler, blocks until stop() is called '''
+        if self.output_stats_thread is None:
+            self.output_stats_thread = threading.Thread(target=self._report_stats, daemon=True)
+            self.output_stats_thread.start()
+        self.run()
+
+    def stop(self):
+        ''' Stop scheduling, collections in progress are not interrupted '''
+        logger.info("Scheduler: Stopping")
+        with self._cond:
+            self._run = False
+            self._cond.notify()
+        self.executor.shutdown(wait=False)
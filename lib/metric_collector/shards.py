@@ -0,0 +1,274 @@
+import fcntl
+import hashlib
+import json
+import logging
+import math
+import os
+import threading
+import time
+import yaml
+
+logger = logging.getLogger('shards')
+
+SHARDING_MODES = ['modulo', 'rendezvous', 'cost']
+
+### Max load of a shard, relative to the average, when hosts are weighted
+DEFAULT_LOAD_FACTOR = 1.25
+
+### Period during which the sharding weights from a CostStore don't change
+DEFAULT_WEIGHTS_EPOCH = 24 * 60 * 60
+
+### Smallest weight of a host, in sec
+MIN_WEIGHT = 0.01
+
+
+def rendezvous_score(host, shard):
+    """ Deterministic pseudo random score of a host on a shard, the same on all collectors """
+    digest = hashlib.blake2b('{}/{}'.format(shard, host).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+
+def rank_shards(host, shard_size):
+    """ Return the shards (0 to shard_size - 1) sorted by preference for a host """
+    return sorted(range(shard_size), key=lambda shard: rendezvous_score(host, shard), reverse=True)
+
+
+def assign_shards(hosts, shard_size, weights=None, load_factor=DEFAULT_LOAD_FACTOR):
+    """
+    Assign each host to a shard with rendezvous hashing (highest random weight)
+
+    A host goes to the shard with the highest score for it, so adding or
+    removing a host doesn't move any other host, and adding or removing a shard
+    only moves the hosts that go to/come from this shard (~1/N of the hosts).
+
+    With weights (cost of each host), a host goes to its preferred shard that
+    stays under load_factor times the average load (rendezvous with bounded
+    loads). Hosts are placed heaviest first, hosts without a weight get the
+    average weight. Ownership is a little less stable than without weights but
+    expensive hosts are spread across the shards.
+
+    All collectors must use exactly the same weights, otherwise they compute
+    different assignments and some hosts are collected twice or not at all:
+    only use a static weights file, not costs measured continuously.
+
+    Return a dict {host: shard}
+    """
+    if shard_size < 1:
+        raise ValueError('shard_size must be at least 1')
+
+    if not weights:
+        return {host: rank_shards(host, shard_size)[0] for host in hosts}
+
+    known = [weights[host] for host in hosts if host in weights]
+    default_weight = sum(known) / len(known) if known else 1
+    host_weights = {host: weights.get(host, default_weight) for host in hosts}
+    capacity = load_factor * sum(host_weights.values()) / shard_size
+
+    loads = [0] * shard_size
+    assignment = {}
+    for host in sorted(hosts, key=lambda host: (-host_weights[host], host)):
+        ranked = rank_shards(host, shard_size)
+        shard = next((s for s in ranked if loads[s] + host_weights[host] <= capacity), None)
+        if shard is None:
+            shard = min(ranked, key=lambda s: loads[s])
+        loads[shard] += host_weights[host]
+        assignment[host] = shard
+
+    return assignment
+
+
+def pack_shards(hosts, shard_size, weights=None):
+    """
+    Assign the hosts to shard_size bins of about the same total weight
+    (longest processing time first: heaviest host to the least loaded shard)
+
+    Used to balance shards and collector threads on the measured cost of the
+    hosts, hosts without a weight get the average weight. The result only
+    depends on the hosts and the weights, for shards the weights must be the
+    same on all collectors (a static file or a CostStore snapshot). Unlike
+    rendezvous hashing a change of weights can move many hosts.
+
+    Return a dict {host: shard}
+    """
+    if shard_size < 1:
+        raise ValueError('shard_size must be at least 1')
+
+    weights = weights or {}
+    known = [weights[host] for host in hosts if host in weights]
+    default_weight = sum(known) / len(known) if known else 1
+
+    loads = [0] * shard_size
+    assignment = {}
+    for host in sorted(hosts, key=lambda host: (-weights.get(host, default_weight), host)):
+        shard = loads.index(min(loads))
+        loads[shard] += weights.get(host, default_weight)
+        assignment[host] = shard
+
+    return assignment
+
+
+def get_epoch(now=None, epoch=DEFAULT_WEIGHTS_EPOCH):
+    """ Index of the period of epoch secs containing now, the same on all collectors """
+    return int((time.time() if now is None else now) // epoch)
+
+
+def quantize_weight(cost, previous=None):
+    """
+    Round a cost on a grid of half octaves (x1.41), with hysteresis: the
+    previous weight is kept as long as the cost stays within one step of it,
+    so the noise of the measures doesn't change the weights
+    """
+    level = 2 * math.log2(max(cost, MIN_WEIGHT))
+    if previous and abs(level - 2 * math.log2(previous)) <= 1:
+        return previous
+    return round(2 ** (round(level) / 2), 4)
+
+
+def select_weights(snapshots, now=None, epoch=DEFAULT_WEIGHTS_EPOCH):
+    """ Return the weights of the latest snapshot whose epoch has started, None if there is none """
+    current = get_epoch(now, epoch)
+    active = [snapshot for snapshot in snapshots if snapshot['epoch'] <= current]
+    if not active:
+        return None
+    return max(active, key=lambda snapshot: snapshot['epoch'])['weights']
+
+
+def load_weights(weights_file, now=None, epoch=DEFAULT_WEIGHTS_EPOCH):
+    """
+    Load the weights of the hosts from a static yaml/json file {host: weight}
+    or from the snapshot of the current epoch of a CostStore file
+
+    Return None if the file can't be loaded, sharding then falls back to unweighted
+    """
+    try:
+        with open(weights_file) as f:
+            weights = yaml.safe_load(f)
+    except (IOError, yaml.YAMLError) as ex:
+        logger.warning('Unable to load the sharding weights from %s: %s', weights_file, ex)
+        return None
+
+    if not isinstance(weights, dict):
+        logger.warning('Sharding weights file %s must be a dict of host: weight', weights_file)
+        return None
+
+    if isinstance(weights.get('snapshots'), list):
+        weights = select_weights(weights['snapshots'], now=now, epoch=epoch)
+        if weights is None:
+            logger.info('No sharding weights snapshot active yet in %s', weights_file)
+            return None
+
+    try:
+        weights = {host: float(weight) for host, weight in weights.items()}
+        return {host: weight for host, weight in weights.items() if weight > 0}
+    except (TypeError, ValueError) as ex:
+        logger.warning('Invalid sharding weight in %s: %s', weights_file, ex)
+        return None
+
+
+class CostStore(object):
+    """
+    Measured cost (execution time in sec) of each command of each host,
+    smoothed with an exponential moving average and saved periodically in a
+    json file used to balance shards and threads
+
+      {'costs': {host: {command: cost}}, 'snapshots': [{'epoch': n, 'weights': {host: weight}}]}
+
+    The file can be shared by several collectors: when saving, the costs
+    measured by this process replace those of the file and the others are kept.
+
+    The costs change all the time and differ between collectors, so shards are
+    never computed from them directly: the first collector saving during epoch
+    n freezes the quantized weights of the hosts (see quantize_weight) in a
+    snapshot that becomes active at epoch n+1. All collectors then shard with
+    the same weights for a whole epoch, and ownership only changes at the
+    first inventory refresh of each epoch.
+    """
+
+    def __init__(self, path, alpha=0.3, save_interval=60, epoch=DEFAULT_WEIGHTS_EPOCH):
+        self.path = path
+        self.alpha = alpha
+        self.save_interval = save_interval
+        self.epoch = epoch
+        self.costs = {}
+        self.measured = set()
+        self._last_save = time.monotonic()
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        """ Load the costs saved on disk, costs measured by this process take precedence """
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (IOError, ValueError) as ex:
+            logger.debug('Unable to load the cost store %s: %s', self.path, ex)
+            saved = {}
+        if not isinstance(saved, dict) or not isinstance(saved.get('costs'), dict):
+            saved = {}
+        saved.setdefault('costs', {})
+        saved.setdefault('snapshots', [])
+
+        with self._lock:
+            for host, costs in saved['costs'].items():
+                if host not in self.measured and isinstance(costs, dict):
+                    self.costs[host] = costs
+        return saved
+
+    def record(self, host, command, cost):
+        """ Record the execution time of a command, saved every save_interval """
+        with self._lock:
+            costs = self.costs.get(host)
+            if costs is None or host not in self.measured:
+                ## Start from the saved costs of the host but own measures replace them
+                costs = self.costs[host] = dict(costs or {})
+                self.measured.add(host)
+            previous = costs.get(command)
+            costs[command] = cost if previous is None else previous + self.alpha * (cost - previous)
+
+            save = time.monotonic() - self._last_save >= self.save_interval
+            if save:
+                self._last_save = time.monotonic()
+        if save:
+            self.save()
+
+    def get_host_costs(self):
+        """ Return the total cost of the commands of each host """
+        with self._lock:
+            return {host: sum(costs.values()) for host, costs in self.costs.items()}
+
+    def save(self, now=None):
+        """ Merge the measured costs with the file, add the snapshot of the next epoch and write it atomically """
+        ## Collectors sharing the file take turns so that a snapshot is never lost
+        try:
+            with open(self.path + '.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                self._save(now)
+        except (IOError, OSError) as ex:
+            logger.error('Unable to save the cost store %s: %s', self.path, ex)
+
+    def _save(self, now=None):
+        saved = self.load()
+        with self._lock:
+            for host in self.measured:
+                saved['costs'][host] = {command: round(cost, 4) for command, cost in self.costs[host].items()}
+
+        next_epoch = get_epoch(now, self.epoch) + 1
+        snapshots = [s for s in saved['snapshots'] if isinstance(s, dict) and 'epoch' in s and 'weights' in s]
+        if not any(s['epoch'] == next_epoch for s in snapshots):
+            previous = select_weights(snapshots, now=next_epoch * self.epoch, epoch=self.epoch) or {}
+            weights = {
+                host: quantize_weight(sum(costs.values()), previous.get(host))
+                for host, costs in saved['costs'].items()
+            }
+            ## Keep the active snapshot for collectors that didn't refresh yet
+            snapshots = sorted((s for s in snapshots if s['epoch'] < next_epoch), key=lambda s: s['epoch'])[-1:]
+            snapshots.append({'epoch': next_epoch, 'weights': weights})
+        saved['snapshots'] = snapshots
+
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(saved, f, separators=(',', ':'), sort_keys=True)
+            os.replace(tmp_path, self.path)
+        except (IOError, OSError) as ex:
+            logger.error('Unable to save the cost store %s: %s', self.path, ex)
@@ -0,0 +1,307 @@
+import logging
+import os
+import struct
+import threading
+import zlib
+
+logger = logging.getLogger('spool')
+
+### Each record is stored as: <length:uint32><crc32:uint32><payload>
+RECORD_HEADER = struct.Struct('>II')
+SEGMENT_SUFFIX = '.seg'
+OFFSET_FILE = 'offset'
+
+
+class Spool(object):
+    """
+    Disk-backed, append-only spool of encoded line-protocol batches
+
+    Batches that could not be delivered are appended to segment files in a
+    directory, the oldest segments are evicted first when the spool grows above
+    max_size and the read position is persisted so that a restart resumes where
+    the replay stopped. A torn record at the end of a segment (crash during a
+    write) is detected with its checksum and truncated on recovery.
+    """
+
+    def __init__(self, directory, max_size=512*1024*1024, segment_size=16*1024*1024,
+                 replay_batches=10, fsync=False):
+
+        self.directory = directory
+        self.max_size = max_size
+        self.segment_size = min(segment_size, max_size)
+        self.replay_batches = replay_batches
+        self.fsync = fsync
+
+        self.nbr_evicted = 0
+
+        self._lock = threading.Lock()
+        self._replay_lock = threading.Lock()
+        self._segments = []
+        self._sizes = {}
+        self._writer = None
+        self._reader = None
+        self._reader_segment = None
+        self._read_segment = None
+        self._read_pos = 0
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.__recover__()
+
+    ### ------------------------------------------------------------------
+    ### Recovery
+    ### ------------------------------------------------------------------
+    def __recover__(self):
+
+        self._segments = sorted(
+            int(f[:-len(SEGMENT_SUFFIX)]) for f in os.listdir(self.directory)
+            if f.endswith(SEGMENT_SUFFIX) and f[:-len(SEGMENT_SUFFIX)].isdigit()
+        )
+
+        ## Only the last segment can have been interrupted in the middle of a write
+        if self._segments:
+            self.__truncate_torn_tail__(self._segments[-1])
+
+        for segment in self._segments:
+            self._sizes[segment] = os.path.getsize(self.__segment_path__(segment))
+
+        read_segment, read_pos = self.__load_offset__()
+        if read_segment in self._segments:
+            ## Segments older than the read position have already been replayed
+            for segment in [s for s in self._segments if s < read_segment]:
+                self.__remove_segment__(segment)
+            self._read_segment = read_segment
+            self._read_pos = min(read_pos, self._sizes[read_segment])
+        elif self._segments:
+            self._read_segment = self._segments[0]
+            self._read_pos = 0
+
+        if self._segments:
+            logger.info('Spool: recovered %s segment(s), %s bytes pending in %s',
+                        len(self._segments), self.size(), self.directory)
+
+    def __truncate_torn_tail__(self, segment):
+
+        path = self.__segment_path__(segment)
+        valid_size = 0
+        with open(path, 'rb') as f:
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                length, crc = RECORD_HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    break
+                valid_size = f.tell()
+
+        if valid_size != os.path.getsize(path):
+            logger.warning('Spool: truncating torn record at the end of %s (%s -> %s bytes)',
+                           path, os.path.getsize(path), valid_size)
+            with open(path, 'r+b') as f:
+                f.truncate(valid_size)
+
+    def __load_offset__(self):
+
+        try:
+            with open(os.path.join(self.directory, OFFSET_FILE)) as f:
+                segment, pos = f.read().split()
+            return int(segment), int(pos)
+        except Exception:
+            return None, 0
+
+    def __save_offset__(self):
+
+        path = os.path.join(self.directory, OFFSET_FILE)
+        with open(path + '.tmp', 'w') as f:
+            f.write('%s %s' % (self._read_segment, self._read_pos))
+        os.replace(path + '.tmp', path)
+
+    ### ------------------------------------------------------------------
+    ### Segments management
+    ### ------------------------------------------------------------------
+    def __segment_path__(self, segment):
+        return os.path.join(self.directory, '%020d%s' % (segment, SEGMENT_SUFFIX))
+
+    def __open_writer__(self):
+
+        if self._writer:
+            if self._sizes[self._segments[-1]] < self.segment_size:
+                return self._writer
+            self._writer.close()
+            self._writer = None
+            reuse_last = False
+        else:
+            ## After a restart, keep filling the last segment if it's not full
+            reuse_last = self._segments and self._sizes[self._segments[-1]] < self.segment_size
+
+        if reuse_last:
+            segment = self._segments[-1]
+        else:
+            segment = self._segments[-1] + 1 if self._segments else 0
+            self._segments.append(segment)
+            self._sizes[segment] = 0
+
+        if self._read_segment is None:
+            self._read_segment = segment
+            self._read_pos = 0
+
+        self._writer = open(self.__segment_path__(segment), 'ab')
+        return self._writer
+
+    def __remove_segment__(self, segment):
+
+        if self._reader_segment == segment:
+            self._reader.close()
+            self._reader = None
+            self._reader_segment = None
+
+        if self._segments and segment == self._segments[-1] and self._writer:
+            self._writer.close()
+            self._writer = None
+
+        try:
+            os.remove(self.__segment_path__(segment))
+        except OSError:
+            pass
+        self._segments.remove(segment)
+        del self._sizes[segment]
+
+        if self._read_segment == segment:
+            self._read_segment = self._segments[0] if self._segments else None
+            self._read_pos = 0
+            self.__save_offset__()
+
+    def __evict__(self):
+        """ Remove the oldest segments until the spool fits in max_size """
+
+        while len(self._segments) > 1 and self.size() > self.max_size:
+            segment = self._segments[0]
+            logger.warning('Spool: size above %s bytes, evicting oldest segment %s',
+                           self.max_size, self.__segment_path__(segment))
+            self.__remove_segment__(segment)
+            self.nbr_evicted += 1
+
+    def size(self):
+        """ Return the number of bytes still to be replayed """
+        size = sum(self._sizes.values())
+        if self._read_segment is not None:
+            size -= self._read_pos
+        return size
+
+    def is_empty(self):
+        return self.size() == 0
+
+    ### ------------------------------------------------------------------
+    ### Append / Replay
+    ### ------------------------------------------------------------------
+    def append(self, batch):
+        """
+        Append an encoded batch (bytes or str) at the end of the spool
+        """
+        if isinstance(batch, str):
+            batch = batch.encode()
+
+        with self._lock:
+            writer = self.__open_writer__()
+            writer.write(RECORD_HEADER.pack(len(batch), zlib.crc32(batch)))
+            writer.write(batch)
+            writer.flush()
+            self._sizes[self._segments[-1]] += RECORD_HEADER.size + len(batch)
+            if self.fsync:
+                os.fsync(writer.fileno())
+            self.__evict__()
+
+    def __read_next__(self):
+        """
+        Return the next record to replay as (segment, pos, next_pos, payload)
+        or None if there is nothing left to replay, must be called with the lock
+        """
+        while self._read_segment is not None:
+
+            if self._reader_segment != self._read_segment:
+                if self._reader:
+                    self._reader.close()
+                self._reader = open(self.__segment_path__(self._read_segment), 'rb')
+                self._reader_segment = self._read_segment
+
+            self._reader.seek(self._read_pos)
+            header = self._reader.read(RECORD_HEADER.size)
+            payload = None
+            if len(header) == RECORD_HEADER.size:
+                length, crc = RECORD_HEADER.unpack(header)
+                payload = self._reader.read(length)
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    logger.error('Spool: corrupted record in %s at %s, skipping the rest of the segment',
+                                 self.__segment_path__(self._read_segment), self._read_pos)
+                    payload = None
+                else:
+                    return self._read_segment, self._read_pos, self._reader.tell(), payload
+
+            ## Nothing more in this segment
+            is_last = self._read_segment == self._segments[-1]
+            if is_last and len(header) == 0:
+                ## Fully replayed, start fresh on next append
+                self.__remove_segment__(self._read_segment)
+                return None
+            elif is_last and payload is None and len(header) < RECORD_HEADER.size:
+                return None
+            self.__remove_segment__(self._read_segment)
+
+        return None
+
+    def replay(self, send, max_batches=None):
+        """
+        Replay up to max_batches batches (oldest first) with send(batch)
+        send must return True if the batch has been delivered, replay stops at
+        the first failure and the batch will be retried on the next call
+
+        Return the number of batches replayed
+        """
+        if max_batches is None:
+            max_batches = self.replay_batches
+
+        ## Only one thread replays at a time, others keep sending live data
+        if not self._replay_lock.acquire(blocking=False):
+            return 0
+
+        nbr_replayed = 0
+        try:
+            while nbr_replayed < max_batches:
+                with self._lock:
+                    record = self.__read_next__()
+                if record is None:
+                    break
+
+                segment, pos, next_pos, payload = record
+                try:
+                    delivered = send(payload)
+                except Exception as ex:
+                    logger.warning('Spool: replay failed: %s', ex)
+                    delivered = False
+                if not delivered:
+                    break
+
+                nbr_replayed += 1
+                with self._lock:
+                    ## The segment may have been evicted while we were sending
+                    if self._read_segment == segment and self._read_pos == pos:
+                        self._read_pos = next_pos
+                        self.__save_offset__()
+        finally:
+            self._replay_lock.release()
+
+        if nbr_replayed:
+            logger.info('Spool: replayed %s batch(es), %s bytes still pending', nbr_replayed, self.size())
+        return nbr_replayed
+
+    def close(self):
+        with self._lock:
+            if self._writer:
+                self._writer.close()
+                self._writer = None
+            if self._reader:
+                self._reader.close()
+                self._reader = None
+                self._reader_segment = None
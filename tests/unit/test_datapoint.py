@@ -0,0 +1,52 @@
+import unittest
+from metric_collector import output
+from metric_collector.datapoint import DatapointBatch, host_tags
+
+
+class Test_DatapointBatch(unittest.TestCase):
+
+  def setUp(self):
+    self.datapoints = [
+      {'measurement': None, 'tags': {'name': 'ge-0/0/0', 'device': 'parsed'}, 'fields': {'mtu': 1514, 'speed': '1g'}},
+      {'measurement': 'alarms', 'tags': {}, 'fields': {'count': 0}},
+      {'measurement': None, 'tags': {'name': 'ge-0/0/1'}, 'fields': {}},
+    ]
+    self.batch = DatapointBatch.from_datapoints(
+      self.datapoints,
+      measurement='interface',
+      host_tags=host_tags({'device': 'r1', 'version': '18.4'}, {'site': 'par'}),
+      timestamp=1000)
+
+  def test_from_datapoints(self):
+
+    self.assertEqual(len(self.batch), 2)
+    self.assertEqual(list(self.batch), [
+      {'measurement': 'interface', 'tags': {'name': 'ge-0/0/0', 'device': 'r1', 'version': '18.4', 'site': 'par'},
+       'fields': {'mtu': 1514, 'speed': '1g'}, 'timestamp': 1000},
+      {'measurement': 'alarms', 'tags': {'device': 'r1', 'version': '18.4', 'site': 'par'},
+       'fields': {'count': 0}, 'timestamp': 1000},
+    ])
+
+  def test_lines(self):
+
+    self.assertEqual(self.batch.lines(), [
+      'interface,name=ge-0/0/0,device=r1,version=18.4,site=par mtu=1514,speed=1g 1000',
+      'alarms,device=r1,version=18.4,site=par count=0 1000',
+    ])
+    ## Datapoints given as dicts are encoded the same way
+    self.assertEqual(output.OutputBatch(list(self.batch)).lines(), [l.encode() for l in self.batch.lines()])
+
+  def test_row_timestamp(self):
+
+    batch = DatapointBatch(measurement='cpu', timestamp=1)
+    batch.append((), (('value', 1),))
+    batch.append((), (('value', 2),), timestamp=2)
+    self.assertEqual(batch.lines(), ['cpu value=1 1', 'cpu value=2 2'])
+
+  def test_output_batch_mixed(self):
+
+    stats = {'measurement': 'stats', 'tags': {'device': 'r1'}, 'fields': {'nbr': 1}, 'timestamp': 2000}
+    batch = output.OutputBatch([self.batch, stats])
+    self.assertEqual(len(batch), 3)
+    self.assertEqual(batch.lines()[-1], b'stats,device=r1 nbr=1 2000')
+    self.assertEqual(list(batch.datapoints)[-1], stats)
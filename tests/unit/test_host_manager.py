@@ -188,3 +188,101 @@ class Test_Validate_Main_Block(unittest.TestCase):
 
       self.assertEqual(hm.get_context('router1'), expected_list)
         
+
+  def test_update_hosts_diff(self):
+
+      hm = HostManager( credentials=cred_pwd_01,
+                        commands=commands_1 )
+      diff = hm.update_hosts(inventory_1)
+      self.assertEqual(diff.added, {'10.10.0.1', '20.20.0.20'})
+      router = hm.hosts['20.20.0.20']
+
+      diff = hm.update_hosts({
+        '10.10.0.1': 'switch site2 lab',
+        '20.20.0.20': 'router site1 lab',
+        '30.30.0.30': 'router site1 lab',
+      })
+      self.assertEqual(diff.added, {'30.30.0.30'})
+      self.assertEqual(diff.removed, set())
+      self.assertEqual(diff.changed, {'10.10.0.1'})
+      self.assertIs(hm.hosts['20.20.0.20'], router)
+
+      diff = hm.update_hosts({'30.30.0.30': 'router site1 lab'})
+      self.assertEqual(diff.removed, {'10.10.0.1', '20.20.0.20'})
+      self.assertEqual(hm.get_target_hosts(['.*']), ['30.30.0.30'])
+
+  def test_tag_matching_regex_and_literal(self):
+
+      hm = HostManager( credentials=cred_pwd_01,
+                        commands=commands_2 )
+      hm.update_hosts({
+        'host1': 'lab Site1',
+        'host2': 'lab-cmd site2',
+        'host3': 'prod',
+      })
+
+      self.assertEqual(hm.get_target_hosts(['site']), ['host1', 'host2'])
+      self.assertEqual(hm.get_target_hosts(['^site[12]$']), ['host1', 'host2'])
+      self.assertEqual(hm.get_target_hosts(['LAB']), ['host1', 'host2'])
+      self.assertEqual(hm.get_target_hosts(['lab$', 'prod']), ['host1', 'host3'])
+
+      ## Memoized results can't be modified by the caller
+      hm.get_target_hosts(['site']).append('host3')
+      self.assertEqual(hm.get_target_hosts(['site']), ['host1', 'host2'])
+
+      cmds = hm.get_target_commands('host2')
+      self.assertEqual(sorted(c for cmd in cmds for c in cmd['commands']), ['show test3', 'show test4'])
+      self.assertEqual(hm.get_target_commands('host2', tags=['lab.*']), hm.get_target_commands('host2'))
+      self.assertEqual(hm.get_credentials('host1')['username'], 'user1')
+      self.assertEqual(hm.get_credentials('host3'), None)
+
+      ## Memoized results are reset when the inventory is updated
+      hm.update_hosts({'host4': 'site4'})
+      self.assertEqual(hm.get_target_hosts(['site']), ['host4'])
+
+  def test_host_plan(self):
+
+      hm = HostManager( credentials=cred_pwd_01,
+                        commands=commands_1 )
+      hm.update_hosts(inventory_2)
+
+      plan = hm.get_host_plan('router1')
+      self.assertEqual(plan.address, '40.40.0.4')
+      self.assertEqual(plan.device_type, 'juniper')
+      self.assertEqual(plan.credential, hm.get_credentials('router1'))
+      self.assertEqual(plan.context, (('site', 'site1'), ('role', 'router')))
+      self.assertEqual([(i, sorted(c)) for i, c in plan.commands], [(120, ['show cpu', 'show test2', 'show version'])])
+      self.assertEqual(hm.get_host_plan('unknown'), None)
+
+      with self.assertRaises(AttributeError):
+        plan.address = '1.1.1.1'
+
+      ## Plans are only rebuilt for the hosts that changed
+      inventory = {
+        'router1': dict(inventory_2['router1']),
+        'switch1': dict(inventory_2['switch1'], address='30.30.0.33'),
+      }
+      switch = hm.get_host_plan('switch1')
+      hm.update_hosts(inventory)
+      self.assertIs(hm.get_host_plan('router1'), plan)
+      self.assertIsNot(hm.get_host_plan('switch1'), switch)
+      self.assertEqual(hm.get_host_plan('switch1').address, '30.30.0.33')
+
+  def test_host_plan_commands(self):
+
+      hm = HostManager( credentials=cred_pwd_01,
+                        commands=commands_1 )
+      hm.update_hosts(inventory_2)
+
+      commands = hm.get_host_commands('router1')
+      self.assertEqual({i: sorted(c) for i, c in commands.items()}, {120: ['show cpu', 'show test2', 'show version']})
+      self.assertEqual({i: sorted(c) for i, c in hm.get_host_commands('router1', tags=['.+']).items()},
+                       {i: sorted(c) for i, c in commands.items()})
+
+  def test_host_plan_no_context(self):
+
+      hm = HostManager( credentials=cred_pwd_01,
+                        commands=commands_1 )
+      ## The netbox inventory sets context to False when no context is configured
+      hm.update_hosts({'router1': {'address': '10.0.0.1', 'tags': ['site1'], 'context': False}})
+      self.assertEqual(hm.get_host_plan('router1').context, ())
@@ -0,0 +1,152 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from metric_collector import cli, inventory
+
+plugin_script = '''
+import sys
+
+class Inventory(object):
+
+  def __init__(self):
+    self.calls = 0
+
+  def generate_inventory(self):
+    self.calls += 1
+    if self.calls == 2:
+      sys.exit('netbox unavailable')
+    return {'router%s' % self.calls: {'address': '10.0.0.1', 'tags': ['lab']}}
+
+def inventory_plugin():
+  return Inventory()
+
+if __name__ == '__main__':
+  raise RuntimeError('must not be executed')
+'''
+
+legacy_script = '''
+import json
+print(json.dumps({'router1': {'address': '10.0.0.1', 'tags': ['lab']}}))
+'''
+
+
+class Test_Inventory_Plugin(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def write_script(self, name, content):
+    path = os.path.join(self.tmp_dir, name)
+    with open(path, 'w') as f:
+      f.write(content)
+    return path
+
+  def test_plugin_in_process(self):
+
+    path = self.write_script('dynamic.py', plugin_script)
+    self.assertEqual(cli.import_inventory(path, retry=1), {'router1': {'address': '10.0.0.1', 'tags': ['lab']}})
+
+    ## The same instance is kept between refreshes, sys.exit in the plugin doesn't stop the collector
+    self.assertEqual(cli.import_inventory(path, retry=1), {})
+    self.assertEqual(list(cli.import_inventory(path, retry=1)), ['router3'])
+    self.assertEqual(inventory.get_plugin(path).calls, 3)
+
+  def test_script_without_plugin(self):
+
+    path = self.write_script('legacy.py', legacy_script)
+    self.assertIsNone(inventory.get_plugin(path))
+    self.assertEqual(list(cli.import_inventory(path, retry=1)), ['router1'])
+
+  def test_unknown_entry_point(self):
+
+    with self.assertRaises(ValueError):
+      inventory.load_plugin('plugin:does-not-exist')
+
+  def test_entry_point_without_importlib_metadata(self):
+
+    ## python 3.7 has neither importlib.metadata nor, by default, the backport
+    with mock.patch.dict(sys.modules, {'importlib.metadata': None, 'importlib_metadata': None}):
+      with self.assertRaises(ValueError):
+        inventory.load_plugin('plugin:does-not-exist')
+
+
+class FakeScheduler(object):
+
+  def __init__(self):
+    self.hosts = []
+    self.event = threading.Event()
+
+  def add_hosts(self, hosts, host_tags=None, refresh=False):
+    self.hosts.append(hosts)
+    self.event.set()
+
+
+class Test_Inventory_Cache(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmp_dir, 'hosts.json')
+    self.hosts = {'router1': {'address': '10.0.0.1', 'tags': ['lab']}}
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def test_update_and_load(self):
+
+    inventory.InventoryCache(self.path).update(self.hosts)
+    cache = inventory.InventoryCache(self.path)
+    self.assertEqual(cache.load(), self.hosts)
+    self.assertTrue(0 <= cache.get_age() < 10)
+
+    stats = cache.get_stats_datapoints()
+    self.assertEqual(stats[0]['measurement'], 'metric_collector_inventory')
+    self.assertEqual(stats[0]['fields']['nbr_hosts'], 1)
+    self.assertEqual(stats[0]['fields']['failed_refreshes'], 0)
+
+  def test_no_cache(self):
+
+    cache = inventory.InventoryCache(self.path)
+    self.assertIsNone(cache.load())
+    self.assertIsNone(cache.failed())
+    self.assertEqual(cache.get_stats_datapoints(), [])
+
+  def test_serve_stale_on_failure(self):
+
+    inventory.InventoryCache(self.path).update(self.hosts)
+    cache = inventory.InventoryCache(self.path)
+
+    with mock.patch.object(cli, 'import_inventory', return_value={}):
+      hosts = cli.select_hosts('hosts.py', ['.*'], None, None, hosts_cache=cache)
+    self.assertEqual(hosts, self.hosts)
+    self.assertEqual(cache.get_stats_datapoints()[0]['fields']['failed_refreshes'], 1)
+
+  def test_start_from_cache(self):
+
+    inventory.InventoryCache(self.path).update(self.hosts)
+    cache = inventory.InventoryCache(self.path)
+    scheduler = FakeScheduler()
+    fresh_hosts = {'router2': {'address': '10.0.0.2', 'tags': ['lab']}}
+    imported = threading.Event()
+
+    def import_inventory(hosts_file):
+      imported.wait(5)
+      return dict(fresh_hosts)
+
+    with mock.patch.object(cli, 'import_inventory', side_effect=import_inventory):
+      cli.select_hosts('hosts.py', ['.*'], None, None, scheduler=scheduler, refresh_interval=3600, hosts_cache=cache)
+      ## The scheduler starts with the cached hosts without waiting for the inventory
+      self.assertEqual(scheduler.hosts, [self.hosts])
+
+      scheduler.event.clear()
+      imported.set()
+      self.assertTrue(scheduler.event.wait(5))
+
+    self.assertEqual(scheduler.hosts[-1], fresh_hosts)
+    self.assertEqual(inventory.InventoryCache(self.path).load(), fresh_hosts)
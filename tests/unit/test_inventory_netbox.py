@@ -6,6 +6,9 @@ import pprint
 import requests_mock
 import yaml 
 import copy
+import tempfile
+import shutil
+from urllib.parse import parse_qs
 from os import path
 
 sys.path.append("inventory")
@@ -123,6 +126,145 @@ class Test_Inventory_Netbox(unittest.TestCase):
         self.assertDictEqual(ansible_inventory, expected_response)
 
 
+class Test_Inventory_Netbox_Incremental(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.config = copy.deepcopy(config_01)
+        self.config['netbox']['main']['cache_file'] = path.join(self.tmp_dir, 'netbox.json')
+        self.config['netbox']['filters'] = {'aa': [{'site': 'aa'}]}
+        self.devices = gen_devices(0, 5)
+        self.queries = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def netbox_api(self, request, context):
+        query = parse_qs(request.query)
+        self.queries.append(query)
+
+        devices = self.devices
+        if 'last_updated__gte' in query:
+            devices = [d for d in devices if d.get('updated')]
+        if 'id' in query:
+            devices = [d for d in devices if str(d['id']) in query['id']]
+        if 'brief' in query:
+            devices = [{'id': d['id'], 'name': d['name']} for d in devices]
+        return {'count': len(devices), 'results': devices}
+
+    @requests_mock.mock()
+    def test_incremental_sync(self, m):
+
+        m.get("http://mock/api/dcim/devices/", json=self.netbox_api)
+
+        inventory = NetboxAsInventory(self.config).generate_inventory()
+        self.assertEqual(sorted(inventory), ['device%s' % i for i in range(5)])
+        self.assertEqual(len(self.queries), 1)
+
+        ## device1 is deleted, device2 is updated and device5 is added
+        del self.devices[1]
+        self.devices[1]['updated'] = True
+        self.devices[1]['primary_ip'] = {'address': '10.1.1.1/32'}
+        self.devices += gen_devices(5, 1)
+        self.devices[-1]['updated'] = True
+        self.queries = []
+
+        inventory = NetboxAsInventory(self.config).generate_inventory()
+        self.assertEqual(sorted(inventory), ['device0', 'device2', 'device3', 'device4', 'device5'])
+        self.assertEqual(inventory['device2']['address'], '10.1.1.1')
+        self.assertEqual(inventory['device5']['context'], [{'platform': 'Junos'}, {'site': 'aa'}])
+        self.assertEqual(len(self.queries), 2)
+        self.assertTrue(any('brief' in q for q in self.queries))
+        self.assertTrue(any('last_updated__gte' in q for q in self.queries))
+
+    @requests_mock.mock()
+    def test_missing_devices(self, m):
+
+        m.get("http://mock/api/dcim/devices/", json=self.netbox_api)
+        NetboxAsInventory(self.config).generate_inventory()
+
+        ## Device listed but not updated and not in the snapshot is fetched by id
+        self.devices += gen_devices(5, 2)
+        inventory = NetboxAsInventory(self.config).generate_inventory()
+        self.assertEqual(len(inventory), 7)
+        self.assertEqual(self.queries[-1]['id'], ['5', '6'])
+
+    @requests_mock.mock()
+    def test_full_sync_on_config_change(self, m):
+
+        m.get("http://mock/api/dcim/devices/", json=self.netbox_api)
+        NetboxAsInventory(self.config).generate_inventory()
+
+        self.config['netbox']['tags']['static'] = ['lab']
+        self.queries = []
+        inventory = NetboxAsInventory(self.config).generate_inventory()
+        self.assertEqual(inventory['device0']['tags'], ['top-of-rack', 'aa', 'lab'])
+        self.assertEqual(len(self.queries), 1)
+        self.assertNotIn('brief', self.queries[0])
+
+
 def load_fixture(name):
 
     return yaml.load(open(here + "/" + FIXTURE_DIR + name + ".json"))
+
+
+def gen_devices(start, count, site='aa'):
+    return [
+        {
+            'id': i,
+            'name': 'device%s' % i,
+            'device_type': {'manufacturer': {'slug': 'juniper'}},
+            'device_role': {'name': 'top-of-rack'},
+            'site': {'name': site},
+            'platform': {'name': 'Junos'},
+            'primary_ip': {'address': '10.0.%s.%s/32' % (i // 256, i % 256)},
+            'custom_fields': {},
+        }
+        for i in range(start, start + count)
+    ]
+
+
+class Test_Inventory_Netbox_Paging(unittest.TestCase):
+
+    def setUp(self):
+        self.config = copy.deepcopy(config_01)
+        self.config['netbox']['main']['page_size'] = 10
+        self.config['netbox']['filters'] = {
+            'aa': [{'site': 'aa'}],
+            'bb': [{'site': 'bb'}],
+        }
+
+    def register_pages(self, m, site, devices):
+        for offset in range(0, max(len(devices), 1), 10):
+            m.get(
+                "http://mock/api/dcim/devices/?site=%s&&offset=%s&limit=10" % (site, offset),
+                json={'count': len(devices), 'results': devices[offset:offset + 10]},
+            )
+
+    @requests_mock.mock()
+    def test_pages_and_groups(self, m):
+
+        self.register_pages(m, 'aa', gen_devices(0, 25, 'aa'))
+        self.register_pages(m, 'bb', gen_devices(100, 5, 'bb'))
+
+        netbox = NetboxAsInventory(self.config)
+        inventory = netbox.generate_inventory()
+
+        self.assertEqual(len(inventory), 30)
+        self.assertEqual(inventory['device24']['tags'], ['top-of-rack', 'aa'])
+        self.assertEqual(inventory['device104']['context'], [{'platform': 'Junos'}, {'site': 'bb'}])
+        self.assertEqual(m.call_count, 4)
+
+    @requests_mock.mock()
+    def test_page_retry(self, m):
+
+        devices = gen_devices(0, 15)
+        self.config['netbox']['filters'] = {'aa': [{'site': 'aa'}]}
+        self.register_pages(m, 'aa', devices)
+        m.get(
+            "http://mock/api/dcim/devices/?site=aa&&offset=10&limit=10",
+            [{'status_code': 502}, {'json': {'count': 15, 'results': devices[10:]}}],
+        )
+
+        netbox = NetboxAsInventory(self.config)
+        self.assertEqual(len(netbox.generate_inventory()), 15)
@@ -0,0 +1,337 @@
+import os
+import re
+import shutil
+import socket
+import struct
+import tempfile
+import time
+import unittest
+import requests_mock
+from unittest import mock
+from metric_collector import output
+from metric_collector.spool import Spool
+
+addr = 'http://mock/write'
+
+def gen_datapoints(size):
+  return [
+    {'measurement': 'cpu', 'tags': {'device': 'r%s' % i}, 'fields': {'value': i}, 'timestamp': i}
+    for i in range(size)
+  ]
+
+
+class Test_Output_Http(unittest.TestCase):
+
+  def setUp(self):
+    self.output = output.HttpOutput(addr)
+
+  @requests_mock.mock()
+  def test_post_batch_delivered(self, m):
+    m.post(addr, status_code=204)
+
+    self.assertEqual([], self.output.post(b'a v=1 1\nb v=2 2'))
+    self.assertEqual(self.output.stats.get(), {'delivered': 2, 'retried': 0, 'dropped': 0})
+
+  @requests_mock.mock()
+  @mock.patch('time.sleep')
+  def test_post_batch_retry(self, m, sleep):
+    m.post(addr, [{'status_code': 503}, {'status_code': 503}, {'status_code': 204}])
+
+    self.assertEqual([], self.output.post(b'a v=1 1'))
+    self.assertEqual(m.call_count, 3)
+    self.assertEqual(self.output.stats.get(), {'delivered': 1, 'retried': 2, 'dropped': 0})
+
+  @requests_mock.mock()
+  @mock.patch('time.sleep')
+  def test_post_batch_retry_exhausted(self, m, sleep):
+    m.post(addr, status_code=500)
+
+    self.output.retries = 2
+    self.assertEqual(self.output.post(b'a v=1 1'), [b'a v=1 1'])
+    self.assertEqual(m.call_count, 3)
+    for call in sleep.call_args_list:
+      self.assertTrue(call[0][0] <= 10)
+
+  @requests_mock.mock()
+  def test_post_batch_partial_write(self, m):
+    m.post(addr, status_code=400,
+           json={'error': "partial write: unable to parse 'b v=': missing field value dropped=0"})
+
+    self.assertEqual([], self.output.post(b'a v=1 1\nb v=\nc v=3 3'))
+    self.assertEqual(m.call_count, 1)
+    self.assertEqual(self.output.stats.get(), {'delivered': 2, 'retried': 0, 'dropped': 1})
+
+  @requests_mock.mock()
+  def test_post_batch_invalid_line_number(self, m):
+    m.post(addr, [
+      {'status_code': 400, 'json': {'code': 'invalid', 'message': 'line 2: missing field value'}},
+      {'status_code': 204}
+    ])
+
+    self.assertEqual([], self.output.post(b'a v=1 1\nb v=\nc v=3 3'))
+    self.assertEqual(m.request_history[1].body, b'a v=1 1\nc v=3 3')
+    self.assertEqual(self.output.stats.get(), {'delivered': 2, 'retried': 0, 'dropped': 1})
+
+  @requests_mock.mock()
+  def test_post_batch_partial_write_retention(self, m):
+    m.post(addr, status_code=400,
+           json={'error': 'partial write: points beyond retention policy dropped=1'})
+
+    self.assertEqual([], self.output.post(b'a v=1 1\nb v=2 2\nc v=3 3'))
+    self.assertEqual(self.output.stats.get(), {'delivered': 2, 'retried': 0, 'dropped': 1})
+
+  @requests_mock.mock()
+  def test_post_batch_permanent_error(self, m):
+    m.post(addr, status_code=413)
+
+    self.assertEqual([], self.output.post(b'a v=1 1\nb v=2 2'))
+    self.assertEqual(m.call_count, 1)
+    self.assertEqual(self.output.stats.get()['dropped'], 2)
+
+  @requests_mock.mock()
+  @mock.patch('time.sleep')
+  def test_spool_only_remaining_lines(self, m, sleep):
+    spool_dir = tempfile.mkdtemp()
+    self.output.spool = Spool(spool_dir)
+    m.post(addr, [
+      {'status_code': 400, 'json': {'code': 'invalid', 'message': 'line 2: missing field value'}},
+      {'status_code': 503}
+    ])
+    self.output.write(output.OutputBatch(gen_datapoints(3)))
+
+    spooled = []
+    self.output.spool.replay(lambda b: spooled.append(b) or True)
+    self.assertEqual(spooled, [b'cpu,device=r0 value=0 0\ncpu,device=r2 value=2 2'])
+    shutil.rmtree(spool_dir)
+
+  def test_find_rejected_lines(self):
+    lines = [b"a,tag=line\\ 3 v=1", b"b v="]
+    error = "unable to parse 'a,tag=line\\ 3 v=1': bad; unable to parse 'b v=': missing field value"
+    self.assertEqual(output.find_rejected_lines(error, lines), {0, 1})
+
+  @requests_mock.mock()
+  @mock.patch('time.sleep')
+  def test_spool_and_replay(self, m, sleep):
+    spool_dir = tempfile.mkdtemp()
+    self.output.spool = Spool(spool_dir)
+    self.output.batch_size = 2
+
+    m.post(addr, status_code=503)
+    self.output.write(output.OutputBatch(gen_datapoints(3)))
+    self.assertFalse(self.output.spool.is_empty())
+
+    m.post(addr, status_code=204)
+    self.output.write(output.OutputBatch(gen_datapoints(1)))
+    self.assertTrue(self.output.spool.is_empty())
+    self.assertEqual(self.output.stats.get()['delivered'], 4)
+
+    shutil.rmtree(spool_dir)
+
+
+class Test_Output_Socket(unittest.TestCase):
+
+  def test_pack_lines(self):
+    lines = [b'a' * 10, b'b' * 10, b'c' * 10, b'd' * 30]
+    self.assertEqual(list(output.pack_lines(lines, 25)),
+                     [b'a' * 10 + b'\n' + b'b' * 10 + b'\n', b'c' * 10 + b'\n', b'd' * 30 + b'\n'])
+
+  def test_send_udp(self):
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(('127.0.0.1', 0))
+    server.settimeout(1)
+    batch = output.OutputBatch(gen_datapoints(100))
+
+    udp = output.create_output('udp', 'udp://127.0.0.1:%s' % server.getsockname()[1], max_payload=512)
+    udp.write(batch)
+
+    received = []
+    while len(received) < len(batch):
+      datagram = server.recv(65535)
+      self.assertTrue(len(datagram) <= 512)
+      received += datagram.splitlines()
+    self.assertEqual(received, batch.lines())
+    self.assertEqual(udp.stats.get()['delivered'], 100)
+
+    udp.close()
+    server.close()
+
+  def test_send_udp_failure_counted_as_dropped(self):
+    udp = output.create_output('udp', 'udp://127.0.0.1:9', max_payload=100)
+    udp.sock = mock.Mock()
+    udp.sock.send.side_effect = [None, OSError('refused'), None, None, None, None]
+    batch = output.OutputBatch(gen_datapoints(10))
+    udp.write(batch)
+
+    stats = udp.stats.get()
+    self.assertEqual(stats['delivered'] + stats['dropped'], 10)
+    self.assertTrue(stats['dropped'] > 0)
+
+  def test_send_unix(self):
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, 'telegraf.sock')
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+
+    unix = output.create_output('unix', 'unix://' + path)
+    unix.write(output.OutputBatch(gen_datapoints(100)))
+    unix.write(output.OutputBatch(gen_datapoints(1)))
+    unix.close()
+
+    conn, _ = server.accept()
+    data = b''
+    while True:
+      chunk = conn.recv(65535)
+      if not chunk:
+        break
+      data += chunk
+    self.assertEqual(data, output.OutputBatch(gen_datapoints(100) + gen_datapoints(1)).data())
+
+    conn.close()
+    server.close()
+    shutil.rmtree(tmp_dir)
+
+
+class Test_Output_Stdout(unittest.TestCase):
+
+  def test_print_single_write(self):
+    buffer = mock.Mock()
+    with mock.patch('sys.stdout', mock.Mock(buffer=buffer)):
+      output.StdoutOutput().write(output.OutputBatch(gen_datapoints(3)))
+
+    buffer.write.assert_called_once_with(
+      b'cpu,device=r0 value=0 0\ncpu,device=r1 value=1 1\ncpu,device=r2 value=2 2\n')
+
+  def test_print_nothing(self):
+    buffer = mock.Mock()
+    with mock.patch('sys.stdout', mock.Mock(buffer=buffer)):
+      output.StdoutOutput().write(output.OutputBatch([]))
+    buffer.write.assert_not_called()
+
+
+class SlowOutput(output.Output):
+
+  name = 'slow'
+
+  def __init__(self, delay):
+    super().__init__()
+    self.delay = delay
+    self.batches = []
+
+  def write(self, batch):
+    time.sleep(self.delay)
+    self.batches.append(batch)
+
+
+class Test_Output_Manager(unittest.TestCase):
+
+  def test_fan_out_shares_encoding(self):
+    fast, slow = SlowOutput(0), SlowOutput(0.01)
+    manager = output.OutputManager([fast, slow])
+    for i in range(5):
+      manager.write(gen_datapoints(2), host='r1')
+    manager.close()
+
+    self.assertEqual(len(fast.batches), 5)
+    self.assertEqual(len(slow.batches), 5)
+    self.assertIs(fast.batches[0], slow.batches[0])
+    self.assertIs(fast.batches[0].lines(), slow.batches[0].lines())
+
+  def test_slow_output_does_not_block(self):
+    fast, slow = SlowOutput(0), SlowOutput(0.5)
+    manager = output.OutputManager([fast, slow], queue_size=1)
+    time_start = time.time()
+    for i in range(5):
+      manager.write(gen_datapoints(1))
+    self.assertTrue(time.time() - time_start < 0.5)
+
+    stats = manager.get_stats_datapoints()
+    self.assertEqual([s['tags']['output_type'] for s in stats], ['slow', 'slow'])
+    self.assertEqual(len(set(s['tags']['output_addr'] for s in stats)), 1)
+    self.assertTrue(slow.stats.get()['dropped'] > 0)
+
+  def test_flush_then_write_stats(self):
+    slow = SlowOutput(0.01)
+    manager = output.OutputManager([slow])
+    for i in range(3):
+      manager.write(gen_datapoints(1))
+    manager.flush()
+    manager.write(manager.get_stats_datapoints())
+    manager.close()
+
+    ## The stats are sent last and count every batch sent before them
+    self.assertEqual(len(slow.batches), 4)
+    self.assertEqual([dp['measurement'] for dp in slow.batches[-1].datapoints], ['metric_collector_output_stats'])
+    self.assertIn(b'queue_size=0 ', slow.batches[-1].lines()[0])
+
+  def test_create_unknown_output(self):
+    with self.assertRaises(ValueError):
+      output.create_output('foo')
+
+  def test_file_output(self):
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, 'out.txt')
+    f = output.create_output('file', 'file://' + path)
+    f.write(output.OutputBatch(gen_datapoints(2)))
+    f.close()
+    with open(path, 'rb') as fh:
+      self.assertEqual(fh.read(), b'cpu,device=r0 value=0 0\ncpu,device=r1 value=1 1\n')
+    shutil.rmtree(tmp_dir)
+
+  def test_log_output_partitions(self):
+    tmp_dir = tempfile.mkdtemp()
+    log = output.create_output('log', tmp_dir)
+    log.write(output.OutputBatch(gen_datapoints(1), host='r1'))
+    log.write(output.OutputBatch(gen_datapoints(2), host='r1'))
+
+    received = []
+    for partition in log.partitions:
+      partition.replay(lambda b: received.append(b) or True)
+    self.assertEqual(received, [b'cpu,device=r0 value=0 0\n',
+                                b'cpu,device=r0 value=0 0\ncpu,device=r1 value=1 1\n'])
+    log.close()
+    shutil.rmtree(tmp_dir)
+
+
+class Test_Output_Remote_Write(unittest.TestCase):
+
+  def test_snappy_literal(self):
+    data = b'x' * 70000
+    compressed = output.snappy_compress_literal(data)
+    ## varint preamble with the uncompressed length
+    self.assertEqual(compressed[:3], bytes([0xf0, 0xa2, 0x04]))
+    self.assertEqual(compressed[3], 61 << 2)
+    self.assertEqual(struct.unpack('<H', compressed[4:6])[0], 65535)
+
+  @requests_mock.mock()
+  def test_remote_write(self, m):
+    m.post('http://mock/api/v1/write', status_code=204)
+    rw = output.create_output('prometheus-remote-write', 'http://mock/api/v1/write')
+    rw.write(output.OutputBatch([
+      {'measurement': 'cpu', 'tags': {'device': 'r1'}, 'fields': {'value': '1.5', 'state': 'up'}, 'timestamp': 2000000}
+    ]))
+
+    request = m.request_history[0]
+    self.assertEqual(request.headers['Content-Encoding'], 'snappy')
+    self.assertIn(b'__name__\x12\tcpu_value', request.body)
+    self.assertIn(b'device\x12\x02r1', request.body)
+    self.assertNotIn(b'cpu_state', request.body)
+    self.assertIn(b'\x09' + struct.pack('<d', 1.5) + b'\x10\x02', request.body)
+
+  def test_remote_write_labels_sorted(self):
+    data = output.encode_remote_write([
+      {'measurement': 'cpu', 'tags': {'Zone': 'a', 'a-b': '1', 'a.b': '2', '1x': '3'}, 'fields': {'v': 1}, 'timestamp': 0}
+    ])
+    ## literal only snappy: skip the preamble and the literal tag
+    body = data[2:]
+    names = [n.decode() for n in re.findall(rb'\n[\x00-\x7f]\n[\x00-\x7f]([A-Za-z_0-9]+)\x12', body)]
+    self.assertEqual(names, sorted(names))
+    self.assertEqual(names, ['Zone', '_1x', '__name__', 'a_b'])
+
+
+class Test_Output_Batch(unittest.TestCase):
+
+  def test_data_fresh_batch(self):
+    batch = output.OutputBatch(gen_datapoints(2))
+    self.assertEqual(batch.data(), b'cpu,device=r0 value=0 0\ncpu,device=r1 value=1 1\n')
+    self.assertEqual(batch.lines(), [b'cpu,device=r0 value=0 0', b'cpu,device=r1 value=1 1'])
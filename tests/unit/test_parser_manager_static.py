@@ -35,3 +35,8 @@ class Test_Validate_Main_Block(unittest.TestCase):
     pm = parser_manager.ParserManager()
     self.assertEqual( pm.cleanup_tag('my tag'), 'my_tag' )
     self.assertEqual( pm.cleanup_tag('my tag=true'), 'my_tag_true' )
+
+  def test_cleanup_tag_interned(self):
+
+    pm = parser_manager.ParserManager()
+    self.assertIs( pm.cleanup_tag(''.join(['ge-0/0/0', ' unit'])), pm.cleanup_tag('ge-0/0/0 unit') )
@@ -0,0 +1,133 @@
+import unittest
+from metric_collector.datapoint import DatapointBatch
+from metric_collector.pipeline import Pipeline
+
+
+class FakeParserManager(object):
+
+  def __init__(self, config):
+    self.config = config
+
+  def get_parser_for(self, command):
+    return {'data': {'parser': dict(self.config, command=command)}}
+
+
+def gen_batch(rows, timestamp=0):
+  batch = DatapointBatch('interface', host_tags=(('device', 'r1'),), timestamp=timestamp)
+  for name, fields in rows:
+    batch.append((('name', name),), tuple(fields.items()))
+  return batch
+
+
+class Test_Pipeline(unittest.TestCase):
+
+  def test_no_stage(self):
+
+    pipeline = Pipeline(FakeParserManager({}))
+    batch = gen_batch([('ge-0/0/0', {'mtu': 1514})])
+    self.assertIs(pipeline.process('r1', 'show interfaces', batch), batch)
+
+  def test_delta(self):
+
+    pipeline = Pipeline(FakeParserManager({'delta': {'heartbeat': 3, 'fields': ['mtu']}}))
+
+    def run(mtu, octets):
+      batch = gen_batch([('ge-0/0/0', {'mtu': mtu, 'octets': octets})])
+      return [dp['fields'] for dp in pipeline.process('r1', 'show interfaces', batch)]
+
+    self.assertEqual(run(1514, 1), [{'mtu': 1514, 'octets': 1}])
+    self.assertEqual(run(1514, 2), [{'octets': 2}])
+    self.assertEqual(run(9000, 3), [{'mtu': 9000, 'octets': 3}])
+    self.assertEqual(run(9000, 4), [{'octets': 4}])
+    self.assertEqual(run(9000, 5), [{'octets': 5}])
+    ## Heartbeat
+    self.assertEqual(run(9000, 6), [{'mtu': 9000, 'octets': 6}])
+
+  def test_delta_drops_unchanged_rows(self):
+
+    pipeline = Pipeline(FakeParserManager({'delta': True}))
+    rows = [('ge-0/0/0', {'mtu': 1514}), ('ge-0/0/1', {'mtu': 1514})]
+    self.assertEqual(len(pipeline.process('r1', 'show interfaces', gen_batch(rows))), 2)
+
+    rows[1] = ('ge-0/0/1', {'mtu': 9000})
+    out = list(pipeline.process('r1', 'show interfaces', gen_batch(rows)))
+    self.assertEqual(out, [{
+      'measurement': 'interface', 'tags': {'name': 'ge-0/0/1', 'device': 'r1'}, 'fields': {'mtu': 9000}, 'timestamp': 0
+    }])
+
+    ## State is kept per host
+    self.assertEqual(len(pipeline.process('r2', 'show interfaces', gen_batch(rows))), 2)
+
+  def test_rate(self):
+
+    pipeline = Pipeline(FakeParserManager({'rate': {'fields': ['input-bytes'], 'counter-bits': 32}}))
+
+    def run(timestamp, value):
+      batch = gen_batch([('ge-0/0/0', {'input-bytes': value, 'mtu': 1514})], timestamp=timestamp * 10**9)
+      return [dp['fields'] for dp in pipeline.process('r1', 'show interfaces', batch)]
+
+    self.assertEqual(run(0, '1000'), [{'input-bytes': '1000', 'mtu': 1514}])
+    self.assertEqual(run(10, '2000'), [{'input-bytes': '2000', 'mtu': 1514, 'input-bytes_rate': 100.0}])
+    ## 32 bits counter wrap
+    self.assertEqual(run(20, 2**32 - 1000)[0]['input-bytes_rate'], (2**32 - 3000) / 10)
+    self.assertEqual(run(30, 1000)[0]['input-bytes_rate'], 200.0)
+    ## Device reboot, the counter is reset
+    self.assertEqual(run(40, 10), [{'input-bytes': 10, 'mtu': 1514}])
+    self.assertEqual(run(50, 20)[0]['input-bytes_rate'], 1.0)
+
+  def test_rate_replace_counters(self):
+
+    pipeline = Pipeline(FakeParserManager({'rate': {'keep-counters': False}}))
+    for timestamp, value in [(0, 0), (2, 10)]:
+      batch = gen_batch([('ge-0/0/0', {'input-bytes': value, 'status': 'up'})], timestamp=timestamp * 10**9)
+      out = [dp['fields'] for dp in pipeline.process('r1', 'show interfaces', batch)]
+    self.assertEqual(out, [{'input-bytes_rate': 5.0, 'status': 'up'}])
+
+  def test_aggregate(self):
+
+    pipeline = Pipeline(FakeParserManager({'aggregate': {'window': 10, 'functions': ['min', 'max', 'mean', 'last']}}))
+
+    def run(timestamp, value):
+      batch = gen_batch([('ge-0/0/0', {'bps': value, 'status': 'up'})], timestamp=timestamp * 10**9)
+      return list(pipeline.process('r1', 'show interfaces', batch))
+
+    self.assertEqual(run(0, 10), [])
+    self.assertEqual(run(5, 30), [])
+    self.assertEqual(run(8, 20), [])
+    out = run(10, 50)
+    self.assertEqual(len(out), 1)
+    self.assertEqual(out[0]['timestamp'], 8 * 10**9)
+    self.assertEqual(out[0]['fields'], {'bps_min': 10, 'bps_max': 30, 'bps_mean': 20.0, 'bps_last': 20, 'status': 'up'})
+    self.assertEqual(run(15, 70), [])
+    self.assertEqual(run(21, 0)[0]['fields']['bps_mean'], 60.0)
+
+  def test_cardinality_drop(self):
+
+    pipeline = Pipeline(FakeParserManager({'cardinality': {'max-series': 2, 'expire': 1, 'top': 1}}))
+
+    def run(names):
+      batch = gen_batch([(name, {'mtu': 1514}) for name in names])
+      out = list(pipeline.process('r1', 'show interfaces', batch))
+      data = [dp['tags']['name'] for dp in out if dp['measurement'] == 'interface']
+      stats = [dp for dp in out if dp['measurement'] == 'metric_collector_cardinality']
+      return data, stats
+
+    data, stats = run(['a', 'b', 'c'])
+    self.assertEqual(data, ['a', 'b'])
+    self.assertEqual(stats[0]['tags'], {'measurement': 'interface', 'device': 'r1'})
+    self.assertEqual(stats[0]['fields'], {'series': 2, 'max_series': 2, 'rejected': 1})
+    self.assertEqual(stats[1]['tags'], {'measurement': 'interface', 'tag': 'name', 'device': 'r1'})
+    self.assertEqual(stats[1]['fields'], {'distinct_values': 3})
+
+    ## Admitted series keep their slot
+    self.assertEqual(run(['c', 'b', 'a'])[0], ['b', 'a'])
+    ## Slots of series not collected anymore are released
+    run(['d'])
+    self.assertEqual(run(['e', 'f', 'a'])[0], ['e', 'f'])
+
+  def test_cardinality_aggregate(self):
+
+    pipeline = Pipeline(FakeParserManager({'cardinality': {'max-series': 1, 'action': 'aggregate'}}))
+    batch = gen_batch([('a', {'octets': 1}), ('b', {'octets': '2'}), ('c', {'octets': 3})])
+    out = [dp for dp in pipeline.process('r1', 'show interfaces', batch) if dp['measurement'] == 'interface']
+    self.assertEqual([(dp['tags']['name'], dp['fields']) for dp in out], [('a', {'octets': 1}), ('other', {'octets': 5})])
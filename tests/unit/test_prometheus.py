@@ -0,0 +1,110 @@
+import sys
+import unittest
+from unittest import mock
+import requests
+from metric_collector import output
+from metric_collector.datapoint import DatapointBatch
+from metric_collector.pipeline import Pipeline
+from metric_collector.prometheus import LatestValueStore, render_datapoints
+
+
+def datapoint(host, value, measurement='interface', name='ge-0/0/0'):
+  return {
+    'measurement': measurement,
+    'tags': {'device': host, 'name': name},
+    'fields': {'in_octets': value, 'status': 'up'},
+  }
+
+
+class Test_Prometheus(unittest.TestCase):
+
+  def test_render_datapoints(self):
+
+    metrics = render_datapoints([datapoint('r1', 10), datapoint('r1', '20', name='a"b')])
+    self.assertEqual(list(metrics), ['interface_in_octets'])
+    self.assertEqual(metrics['interface_in_octets'], [
+      'interface_in_octets{device="r1",name="ge-0/0/0"} 10.0',
+      'interface_in_octets{device="r1",name="a\\"b"} 20.0',
+    ])
+
+  def test_store_keeps_latest_value_per_host(self):
+
+    store = LatestValueStore()
+    store.update('r1', [datapoint('r1', 1), datapoint('r1', 5, measurement='cpu', name='re0')])
+    store.update('r2', [datapoint('r2', 2)])
+    store.update('r1', [datapoint('r1', 3)])
+
+    self.assertEqual(store.render().decode(), '\n'.join([
+      '# TYPE cpu_in_octets untyped',
+      'cpu_in_octets{device="r1",name="re0"} 5.0',
+      '# TYPE interface_in_octets untyped',
+      'interface_in_octets{device="r1",name="ge-0/0/0"} 3.0',
+      'interface_in_octets{device="r2",name="ge-0/0/0"} 2.0',
+    ]) + '\n')
+
+  def test_store_with_delta(self):
+
+    class ParserManager(object):
+      def get_parser_for(self, command):
+        return {'data': {'parser': {'delta': True}}}
+
+    pipeline = Pipeline(ParserManager())
+    store = LatestValueStore()
+    for octets in [1, 2, 3]:
+      batch = DatapointBatch('intf', host_tags=(('device', 'r1'),))
+      batch.append((('name', 'a'),), (('mtu', 1514), ('octets', octets)))
+      batch.append((('name', 'b'),), (('mtu', 1514), ('octets', 0)))
+      store.update('r1', pipeline.process('r1', 'show interfaces', batch))
+
+    ## Fields and series suppressed by the delta stage keep their last value
+    self.assertEqual(store.render().decode(), '\n'.join([
+      '# TYPE intf_mtu untyped',
+      'intf_mtu{device="r1",name="a"} 1514.0',
+      'intf_mtu{device="r1",name="b"} 1514.0',
+      '# TYPE intf_octets untyped',
+      'intf_octets{device="r1",name="a"} 3.0',
+      'intf_octets{device="r1",name="b"} 0.0',
+    ]) + '\n')
+
+  def test_stats_without_host(self):
+
+    store = LatestValueStore()
+    store.update('', [{'measurement': 'worker_stats', 'tags': {'worker_name': 'Interval-60sec'}, 'fields': {'nbr': 1}}])
+    store.update('', [{'measurement': 'worker_stats', 'tags': {'worker_name': 'Interval-300sec'}, 'fields': {'nbr': 2}}])
+    store.update('', [{'measurement': 'output_stats', 'tags': {'output': 'http'}, 'fields': {'sent': 3}}])
+    self.assertEqual(len(store.render().decode().splitlines()), 5)
+
+  def test_create_output_without_import(self):
+
+    with mock.patch.dict(output.OUTPUTS), mock.patch.dict(sys.modules):
+      del output.OUTPUTS['prometheus']
+      del sys.modules['metric_collector.prometheus']
+      self.assertIn('prometheus', output.get_output_types())
+      out = output.create_output('prometheus', '127.0.0.1:0')
+      out.close()
+
+  def test_store_expire(self):
+
+    store = LatestValueStore(max_age=-1)
+    store.update('r1', [datapoint('r1', 1)])
+    self.assertEqual(store.render(openmetrics=True), b'# EOF\n')
+
+  def test_metrics_endpoint(self):
+
+    out = output.create_output('prometheus', '127.0.0.1:0')
+    try:
+      out.write(output.OutputBatch([datapoint('r1', 1)], host='r1'))
+      url = 'http://127.0.0.1:%s' % out.server.server_address[1]
+
+      resp = requests.get(url + '/metrics')
+      self.assertEqual(resp.status_code, 200)
+      self.assertIn('interface_in_octets{device="r1",name="ge-0/0/0"} 1.0', resp.text)
+
+      resp = requests.get(url + '/metrics', headers={'Accept': 'application/openmetrics-text'})
+      self.assertTrue(resp.headers['Content-Type'].startswith('application/openmetrics-text'))
+      self.assertTrue(resp.text.endswith('# EOF\n'))
+
+      self.assertEqual(requests.get(url + '/').status_code, 404)
+      self.assertEqual(out.stats.get()['delivered'], 1)
+    finally:
+      out.close()
@@ -0,0 +1,113 @@
+import threading
+import time
+import unittest
+from metric_collector import scheduler
+
+commands = {
+  'lab_commands': {
+    'netconf': ['show version'],
+    'tags': ['lab'],
+  }
+}
+
+
+class FakeCollector(object):
+
+  def __init__(self, duration=0):
+    self.collected = []
+    self.duration = duration
+    self._lock = threading.Lock()
+
+  def collect(self, worker_name, hosts=None, host_cmds=None, cmd_tags=None):
+    with self._lock:
+      for host in host_cmds:
+        self.collected.append((host, time.monotonic()))
+    time.sleep(self.duration)
+
+
+class FakeOutput(object):
+
+  def write(self, datapoints, host=None):
+    pass
+
+  def get_stats_datapoints(self):
+    return []
+
+
+class Test_Scheduler(unittest.TestCase):
+
+  def setUp(self):
+    self.scheduler = scheduler.Scheduler({}, commands, [], FakeOutput(), num_threads_per_worker=4)
+    self.scheduler.collector = FakeCollector()
+    ## Intervals shorter than a second to keep the tests fast
+    self.scheduler._get_hostcmds = lambda hosts, tags: {h: {0.2: ['show version']} for h in hosts}
+
+  def tearDown(self):
+    self.scheduler.stop()
+
+  def run_scheduler(self, duration):
+    thread = threading.Thread(target=self.scheduler.start, daemon=True)
+    thread.start()
+    time.sleep(duration)
+    self.scheduler.stop()
+    thread.join(1)
+    self.assertFalse(thread.is_alive())
+
+  def test_phase_offset(self):
+
+    hosts = ['router%s' % i for i in range(1000)]
+    offsets = [scheduler.get_phase_offset(h, 60) for h in hosts]
+
+    self.assertEqual(offsets, [scheduler.get_phase_offset(h, 60) for h in hosts])
+    self.assertTrue(all(0 <= o < 60 for o in offsets))
+    ## Roughly the same number of hosts in each 10 secs slot
+    for slot in range(6):
+      nbr = len([o for o in offsets if slot * 10 <= o < (slot + 1) * 10])
+      self.assertTrue(100 < nbr < 250, nbr)
+
+  def test_fixed_rate(self):
+
+    self.scheduler.add_hosts({'router%s' % i: 'lab' for i in range(5)})
+    start = time.monotonic()
+    self.run_scheduler(1.1)
+
+    for i in range(5):
+      host = 'router%s' % i
+      starts = [t - start for h, t in self.scheduler.collector.collected if h == host]
+      self.assertTrue(5 <= len(starts) <= 6, starts)
+      for n, t in enumerate(starts):
+        self.assertAlmostEqual(t, scheduler.get_phase_offset(host, 0.2) + n * 0.2, delta=0.05)
+
+  def test_skip_overrun(self):
+
+    self.scheduler.collector = FakeCollector(duration=0.5)
+    self.scheduler.add_hosts({'router1': 'lab'})
+    self.run_scheduler(1.1)
+
+    self.assertEqual(len(self.scheduler.collector.collected), 2)
+    stats = self.scheduler.get_stats_datapoints()
+    self.assertEqual(len(stats), 1)
+    self.assertEqual(stats[0]['tags']['worker_name'], 'Interval-0.2sec')
+    self.assertTrue(stats[0]['fields']['missed_cycles'] >= 3)
+    self.assertEqual(stats[0]['fields']['nbr_devices'], 1)
+
+  def test_refresh_only_touches_changes(self):
+
+    self.scheduler.add_hosts({'router1': 'lab', 'router2': 'lab'})
+    job = self.scheduler.jobs[('router2', 0.2)]
+    thread = threading.Thread(target=self.scheduler.start, daemon=True)
+    thread.start()
+    time.sleep(0.5)
+
+    self.scheduler.add_hosts({'router2': 'lab', 'router3': 'lab'})
+    self.assertEqual(sorted(self.scheduler.jobs), [('router2', 0.2), ('router3', 0.2)])
+    self.assertIs(self.scheduler.jobs[('router2', 0.2)], job)
+    collected = len(self.scheduler.collector.collected)
+    time.sleep(0.5)
+    self.scheduler.stop()
+
+    hosts = [h for h, _ in self.scheduler.collector.collected[collected:]]
+    self.assertNotIn('router1', hosts)
+    self.assertIn('router2', hosts)
+    self.assertIn('router3', hosts)
+    self.assertEqual(self.scheduler.host_mgr.get_target_hosts(['.*']), ['router2', 'router3'])
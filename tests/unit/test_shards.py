@@ -0,0 +1,148 @@
+import os
+import shutil
+import tempfile
+import unittest
+from metric_collector import shards
+from metric_collector.cli import shard_host_list
+
+
+def gen_hosts(start, count):
+  return ['host-{:04}'.format(i) for i in range(start, start + count)]
+
+
+class Test_Shards(unittest.TestCase):
+
+  def test_balanced(self):
+
+    assignment = shards.assign_shards(gen_hosts(0, 3000), 3)
+    for shard in range(3):
+      nbr = len([h for h, s in assignment.items() if s == shard])
+      self.assertTrue(900 < nbr < 1100, nbr)
+
+  def test_add_shard_moves_few_hosts(self):
+
+    hosts = gen_hosts(0, 3000)
+    before = shards.assign_shards(hosts, 3)
+    after = shards.assign_shards(hosts, 4)
+
+    moved = [h for h in hosts if before[h] != after[h]]
+    ## Only the hosts taken by the new shard move
+    self.assertTrue(all(after[h] == 3 for h in moved))
+    self.assertTrue(600 < len(moved) < 900, len(moved))
+
+  def test_add_host_moves_no_host(self):
+
+    before = shards.assign_shards(gen_hosts(0, 100), 3)
+    after = shards.assign_shards(gen_hosts(0, 101), 3)
+    self.assertEqual({h: s for h, s in after.items() if h in before}, before)
+
+  def test_weights(self):
+
+    hosts = gen_hosts(0, 100)
+    weights = {h: 1 for h in hosts}
+    weights.update({h: 50 for h in hosts[:6]})
+    assignment = shards.assign_shards(hosts, 3, weights=weights)
+
+    loads = [0, 0, 0]
+    for host, shard in assignment.items():
+      loads[shard] += weights[host]
+    self.assertTrue(max(loads) <= 1.25 * sum(loads) / 3, loads)
+    ## The expensive hosts are not all on the same shard
+    self.assertTrue(len(set(assignment[h] for h in hosts[:6])) > 1)
+
+  def test_shard_host_list_rendezvous(self):
+
+    hosts = {h: {} for h in gen_hosts(0, 30)}
+    selected = [shard_host_list(i, 3, dict(hosts), mode='rendezvous') for i in range(1, 4)]
+    self.assertEqual(sorted(h for shard in selected for h in shard), sorted(hosts))
+
+
+class Test_CostStore(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmp_dir, 'costs.json')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def test_pack_shards(self):
+
+    weights = {'mx960': 100, 'mx480': 60, 'mx240': 40}
+    weights.update({'ex%s' % i: 1 for i in range(20)})
+    assignment = shards.pack_shards(sorted(weights), 2, weights=weights)
+
+    loads = [0, 0]
+    for host, shard in assignment.items():
+      loads[shard] += weights[host]
+    self.assertEqual(loads, [110, 110])
+
+  def test_record_and_share(self):
+
+    store = shards.CostStore(self.path, alpha=0.5)
+    store.record('r1', 'show interfaces', 10)
+    store.record('r1', 'show interfaces', 20)
+    store.record('r1', 'show version', 1)
+    self.assertEqual(store.get_host_costs(), {'r1': 16})
+    store.save()
+
+    ## Another collector sharing the file keeps the costs of the others
+    other = shards.CostStore(self.path)
+    other.record('r2', 'show version', 2)
+    other.save()
+    self.assertEqual(other.get_host_costs(), {'r1': 16, 'r2': 2})
+
+    store.record('r1', 'show version', 1)
+    store.save()
+    self.assertEqual(shards.CostStore(self.path).get_host_costs(), {'r1': 16, 'r2': 2})
+
+  def test_quantize_weight(self):
+
+    self.assertEqual(shards.quantize_weight(16), 16)
+    self.assertEqual(shards.quantize_weight(20), 22.6274)
+    ## Noise around the previous weight doesn't change it
+    self.assertEqual(shards.quantize_weight(20, previous=16), 16)
+    self.assertEqual(shards.quantize_weight(12, previous=16), 16)
+    self.assertEqual(shards.quantize_weight(40, previous=16), 45.2548)
+    self.assertTrue(0 < shards.quantize_weight(0) < 2 * shards.MIN_WEIGHT)
+
+  def test_weights_snapshot_per_epoch(self):
+
+    epoch = 3600
+    hosts = gen_hosts(0, 200)
+    stores = [shards.CostStore(self.path, epoch=epoch) for _ in range(2)]
+    for i, host in enumerate(hosts):
+      stores[i % 2].record(host, 'show interfaces', 1 + i % 7)
+
+    ## Nothing is active before the first snapshot's epoch starts
+    stores[0].save(now=10 * epoch + 10)
+    stores[1].save(now=10 * epoch + 20)
+    self.assertIsNone(shards.load_weights(self.path, now=10 * epoch + 30, epoch=epoch))
+    weights = shards.load_weights(self.path, now=11 * epoch, epoch=epoch)
+    self.assertEqual(len(weights), 100)
+
+    ## The snapshot doesn't change during its epoch whatever the collectors measure
+    for i, host in enumerate(hosts):
+      stores[i % 2].record(host, 'show interfaces', 2 + i % 7)
+    stores[0].save(now=11 * epoch + 10)
+    stores[1].save(now=11 * epoch + 20)
+    self.assertEqual(shards.load_weights(self.path, now=11 * epoch + 30, epoch=epoch), weights)
+
+  def test_weights_hysteresis(self):
+
+    epoch = 3600
+    hosts = gen_hosts(0, 200)
+    store = shards.CostStore(self.path, alpha=1, epoch=epoch)
+    for i, host in enumerate(hosts):
+      store.record(host, 'show interfaces', 1 + i % 13)
+    store.save(now=0)
+    before = shards.load_weights(self.path, now=epoch, epoch=epoch)
+
+    ## 10% drift on 20 hosts over the next epoch
+    for host in hosts[:20]:
+      store.record(host, 'show interfaces', store.get_host_costs()[host] * 1.1)
+    store.save(now=epoch)
+    after = shards.load_weights(self.path, now=2 * epoch, epoch=epoch)
+
+    self.assertEqual(after, before)
+    self.assertEqual(shards.pack_shards(hosts, 4, weights=after), shards.pack_shards(hosts, 4, weights=before))
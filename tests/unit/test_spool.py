@@ -0,0 +1,70 @@
+import os
+import shutil
+import tempfile
+import unittest
+from metric_collector.spool import Spool
+
+
+class Test_Spool(unittest.TestCase):
+
+  def setUp(self):
+    self.spool_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.spool_dir)
+
+  def test_append_replay(self):
+
+    spool = Spool(self.spool_dir)
+    spool.append(b'cpu value=1 1')
+    spool.append('cpu value=2 2')
+
+    sent = []
+    self.assertEqual(spool.replay(lambda b: sent.append(b) or True), 2)
+    self.assertEqual(sent, [b'cpu value=1 1', b'cpu value=2 2'])
+    self.assertTrue(spool.is_empty())
+
+  def test_replay_stops_on_failure(self):
+
+    spool = Spool(self.spool_dir)
+    for i in range(3):
+      spool.append('cpu value=%s %s' % (i, i))
+
+    self.assertEqual(spool.replay(lambda b: False), 0)
+
+    sent = []
+    self.assertEqual(spool.replay(lambda b: sent.append(b) or True, max_batches=2), 2)
+    self.assertEqual(sent, [b'cpu value=0 0', b'cpu value=1 1'])
+    self.assertFalse(spool.is_empty())
+
+  def test_evict_oldest(self):
+
+    spool = Spool(self.spool_dir, max_size=100, segment_size=40)
+    for i in range(10):
+      spool.append('cpu value=%s %s' % (i, i))
+
+    sent = []
+    spool.replay(lambda b: sent.append(b) or True, max_batches=100)
+    self.assertTrue(spool.nbr_evicted > 0)
+    self.assertEqual(sent[-1], b'cpu value=9 9')
+    self.assertNotIn(b'cpu value=0 0', sent)
+
+  def test_recover_after_restart(self):
+
+    spool = Spool(self.spool_dir)
+    for i in range(3):
+      spool.append('cpu value=%s %s' % (i, i))
+    spool.replay(lambda b: True, max_batches=1)
+    spool.close()
+
+    ## Simulate a crash in the middle of a write
+    segment = sorted(f for f in os.listdir(self.spool_dir) if f.endswith('.seg'))[-1]
+    with open(os.path.join(self.spool_dir, segment), 'ab') as f:
+      f.write(b'\x00\x00\x00\xffgarbage')
+
+    spool = Spool(self.spool_dir)
+    spool.append('cpu value=3 3')
+
+    sent = []
+    spool.replay(lambda b: sent.append(b) or True)
+    self.assertEqual(sent, [b'cpu value=1 1', b'cpu value=2 2', b'cpu value=3 3'])